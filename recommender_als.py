@@ -0,0 +1,209 @@
+"""Matrix factorization recommendations trained by alternating least squares.
+
+AlsModel.train factors the ratings into a num_factors long vector per user and
+per movie, so that a user's rating of a movie is close to the dot product of
+their vectors. Training alternates between solving every user's vector with
+the movie vectors fixed and every movie's vector with the user vectors fixed;
+each of those is a small num_factors x num_factors regularized least squares
+problem.
+
+A target user who is not in the training data is folded in at query time: one
+more least squares solve, over the movies they rated, gives their vector, and
+every movie is scored by a dot product with it.
+"""
+
+import random
+from array import array
+from typing import Dict, List
+
+from recommender_constants import MovieDict, Rating, UserRatingDict, \
+    MovieUserDict
+from recommender_functions import get_top_movies
+from recommender_store import ID_TYPE, NORM_TYPE
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """Return x such that matrix x = vector, for a symmetric positive
+    definite matrix, by Cholesky decomposition.
+
+    >>> _solve([[4.0, 2.0], [2.0, 2.0]], [8.0, 6.0])
+    [1.0, 2.0]
+    """
+    n = len(vector)
+    lower = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i + 1):
+            total = matrix[i][j]
+            for k in range(j):
+                total -= lower[i][k] * lower[j][k]
+            if i == j:
+                lower[i][i] = total ** 0.5
+            else:
+                lower[i][j] = total / lower[j][j]
+    forward = [0.0] * n
+    for i in range(n):
+        total = vector[i]
+        for k in range(i):
+            total -= lower[i][k] * forward[k]
+        forward[i] = total / lower[i][i]
+    result = [0.0] * n
+    for i in range(n - 1, -1, -1):
+        total = forward[i]
+        for k in range(i + 1, n):
+            total -= lower[k][i] * result[k]
+        result[i] = total / lower[i][i]
+    return result
+
+
+def _least_squares(pairs: List[tuple], factors: Dict[int, List[float]],
+                   num_factors: int, regularization: float) -> List[float]:
+    """Return the vector x minimizing the sum over (key, rating) in pairs of
+    (rating - x . factors[key]) ** 2, plus regularization * |x| ** 2.
+    """
+    matrix = [[0.0] * num_factors for _ in range(num_factors)]
+    vector = [0.0] * num_factors
+    for key, rating in pairs:
+        y = factors[key]
+        for i in range(num_factors):
+            vector[i] += rating * y[i]
+            row = matrix[i]
+            for j in range(i + 1):
+                row[j] += y[i] * y[j]
+    for i in range(num_factors):
+        matrix[i][i] += regularization
+        for j in range(i):
+            matrix[j][i] = matrix[i][j]
+    return _solve(matrix, vector)
+
+
+class AlsModel:
+    """Movie factors learned from ratings, for scoring any target user.
+
+    === Public Attributes ===
+    num_factors: the length of each user and movie vector
+    regularization: the weight of the vector length penalty
+    movie_ids: the sorted ids of the movies with factors
+    movie_factors: the vectors of the movies in movie_ids, one after another
+
+    === Private Attributes ===
+    _movie_index: the position of each movie id in movie_ids
+
+    >>> ratings = {1: {10: 5.0, 11: 5.0, 12: 1.0}, 2: {10: 5.0, 11: 4.5},
+    ...            3: {12: 5.0, 13: 5.0, 10: 1.0}, 4: {12: 4.5, 13: 5.0}}
+    >>> model = AlsModel.train(ratings, num_factors=2, iterations=15)
+    >>> model.recommend_movies({10: 5.0}, {}, ratings, {}, 1)
+    [11]
+    """
+    num_factors: int
+    regularization: float
+    movie_ids: array
+    movie_factors: array
+    _movie_index: Dict[int, int]
+
+    def __init__(self, num_factors: int, regularization: float,
+                 movie_ids: array, movie_factors: array) -> None:
+        """Initialize a model with already-trained movie factors.
+        """
+        self.num_factors = num_factors
+        self.regularization = regularization
+        self.movie_ids = movie_ids
+        self.movie_factors = movie_factors
+        self._movie_index = {}
+        for i in range(len(movie_ids)):
+            self._movie_index[movie_ids[i]] = i
+
+    @classmethod
+    def train(cls, user_ratings: UserRatingDict, num_factors: int = 10,
+              regularization: float = 0.1, iterations: int = 10,
+              seed: int = 148) -> 'AlsModel':
+        """Return a model trained on user_ratings by alternating least
+        squares.
+        """
+        movie_users = {}
+        for user in user_ratings:
+            rating = user_ratings[user]
+            for movie in rating:
+                movie_users.setdefault(movie, []).append(
+                    (user, rating[movie]))
+        rand = random.Random(seed)
+        movie_vectors = {}
+        for movie in sorted(movie_users):
+            movie_vectors[movie] = [rand.gauss(0.0, 0.1)
+                                    for _ in range(num_factors)]
+        user_vectors = {}
+        for _ in range(iterations):
+            for user in user_ratings:
+                rating = user_ratings[user]
+                user_vectors[user] = _least_squares(
+                    [(movie, rating[movie]) for movie in rating],
+                    movie_vectors, num_factors, regularization)
+            for movie in movie_vectors:
+                movie_vectors[movie] = _least_squares(
+                    movie_users[movie], user_vectors, num_factors,
+                    regularization)
+
+        movie_ids = array(ID_TYPE, sorted(movie_vectors))
+        movie_factors = array(NORM_TYPE)
+        for movie in movie_ids:
+            movie_factors.extend(movie_vectors[movie])
+        return cls(num_factors, regularization, movie_ids, movie_factors)
+
+    def fold_in(self, target_rating: Rating) -> List[float]:
+        """Return the vector of a user with target_rating, with the movie
+        factors fixed. Movies without factors are ignored.
+        """
+        pairs = [(movie, target_rating[movie]) for movie in target_rating
+                 if movie in self._movie_index]
+        return _least_squares(pairs, _Vectors(self, self._movie_index),
+                              self.num_factors, self.regularization)
+
+    def get_movie_score(self, target_rating: Rating) -> Dict[int, float]:
+        """Return a dictionary of every movie not in target_rating to its
+        predicted rating for a user with target_rating.
+        """
+        x = self.fold_in(target_rating)
+        k = self.num_factors
+        factors = self.movie_factors
+        scores = {}
+        for i in range(len(self.movie_ids)):
+            movie = self.movie_ids[i]
+            if movie not in target_rating:
+                base = i * k
+                total = 0.0
+                for j in range(k):
+                    total += x[j] * factors[base + j]
+                scores[movie] = total
+        return scores
+
+    def recommend_movies(self, target_rating: Rating, movies: MovieDict,
+                         user_ratings: UserRatingDict,
+                         movie_users: MovieUserDict,
+                         num_movies: int) -> List[int]:
+        """Return a list of num_movies movie id recommendations for a target
+        user with target_rating: the movies with the highest predicted
+        ratings.
+
+        Takes the same arguments as recommender_functions.recommend_movies so
+        either can serve a request; movies, user_ratings and movie_users are
+        not needed at query time.
+        """
+        return get_top_movies(self.get_movie_score(target_rating),
+                              num_movies)
+
+
+class _Vectors:
+    """A {movie id: vector} view of the movie factors of an AlsModel.
+    """
+
+    def __init__(self, model: AlsModel, index: Dict[int, int]) -> None:
+        """Initialize a view of model's factors, located through index.
+        """
+        self._model = model
+        self._index = index
+
+    def __getitem__(self, movie: int) -> List[float]:
+        """Return the vector of movie.
+        """
+        k = self._model.num_factors
+        base = self._index[movie] * k
+        return self._model.movie_factors[base:base + k]
@@ -0,0 +1,430 @@
+"""Synthetic MovieLens-style data and a benchmark of the recommender stages.
+
+generate_dataset writes a movies file and a ratings file in the format that
+read_movies and read_ratings expect, with power-law (Zipf) movie popularity
+and user activity, at any scale from thousands to hundreds of millions of
+ratings. Rows are written as they are generated, so memory does not grow with
+the number of ratings.
+
+run_benchmark times read_ratings, movies_to_users, get_similar_users,
+get_movie_score and recommend_movies separately and returns throughput,
+p50/p99 latency and peak RSS as a JSON-ready dictionary; compare_results
+checks a run against a stored baseline.
+
+measure_pruning compares recommend_movies with a cap on the number of
+similar users (and optionally a similarity floor) to the unpruned results:
+how many of the recommendations stay the same, and how latency changes.
+measure_ann does the same for the recall of MinHashIndex settings.
+
+Usage:
+
+    python recommender_benchmark.py generate DIR --ratings 1000000
+    python recommender_benchmark.py run DIR --output now.json \\
+        --baseline before.json
+    python recommender_benchmark.py prune DIR --caps 10 50 200 1000
+    python recommender_benchmark.py recall DIR --settings 16x4 32x2 64x1
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from recommender_ann import MinHashIndex, measure_recall
+from recommender_functions import (read_movies, read_ratings,
+                                   remove_unknown_movies, movies_to_users,
+                                   get_similar_users, get_movie_score,
+                                   recommend_movies)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RATING_VALUES = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+# Roughly the MovieLens rating distribution, which leans towards 3 to 4.
+RATING_WEIGHTS = [1, 3, 2, 7, 5, 20, 12, 27, 9, 14]
+GENRES = ['Action', 'Adventure', 'Animation', 'Comedy', 'Crime', 'Drama',
+          'Fantasy', 'Horror', 'Romance', 'Sci-Fi', 'Thriller']
+
+
+def _zipf_cumulative(n: int, exponent: float) -> List[float]:
+    """Return the cumulative weights of ranks 1 to n under a Zipf law.
+
+    >>> [round(w, 2) for w in _zipf_cumulative(3, 1.0)]
+    [1.0, 1.5, 1.83]
+    """
+    return list(itertools.accumulate(1.0 / rank ** exponent
+                                     for rank in range(1, n + 1)))
+
+
+def generate_dataset(directory: str, num_users: int = 1000,
+                     num_movies: int = 2000, num_ratings: int = 100000,
+                     exponent: float = 1.0,
+                     seed: int = 148) -> Tuple[str, str]:
+    """Write movies.csv and ratings.csv with about num_ratings ratings into
+    directory, and return their paths.
+
+    Movie popularity and the number of ratings per user both follow a Zipf
+    law with the given exponent; see user_counts. Movie ids are spread out
+    like MovieLens ids, so they are not dense.
+
+    Raise ValueError if num_ratings is more than num_users * num_movies.
+    """
+    counts = user_counts(num_users, num_movies, num_ratings, exponent)
+    os.makedirs(directory, exist_ok=True)
+    rand = random.Random(seed)
+    movie_ids = sorted(rand.sample(range(1, num_movies * 20), num_movies))
+    movie_path = os.path.join(directory, 'movies.csv')
+    with open(movie_path, 'w') as movie_file:
+        movie_file.write('movieId,title,release_date,vote_average,genres\n')
+        for movie in movie_ids:
+            genres = rand.sample(GENRES, rand.randint(0, 3))
+            movie_file.write(','.join([str(movie), 'Movie {}'.format(movie),
+                                       '2000-01-01', '5.0'] + genres) + '\n')
+
+    popular = movie_ids[:]
+    rand.shuffle(popular)
+    movie_weights = _zipf_cumulative(num_movies, exponent)
+    rating_path = os.path.join(directory, 'ratings.csv')
+    with open(rating_path, 'w') as rating_file:
+        rating_file.write('userId,movieId,rating\n')
+        for user in range(1, num_users + 1):
+            count = counts[user - 1]
+            chosen = set()
+            while len(chosen) < count:
+                chosen.update(rand.choices(popular, cum_weights=movie_weights,
+                                           k=count - len(chosen)))
+            rates = rand.choices(RATING_VALUES, RATING_WEIGHTS, k=count)
+            rows = ['{},{},{}\n'.format(user, movie, rate)
+                    for movie, rate in zip(sorted(chosen), rates)]
+            rating_file.writelines(rows)
+    return movie_path, rating_path
+
+
+def user_counts(num_users: int, num_movies: int, num_ratings: int,
+                exponent: float = 1.0) -> List[int]:
+    """Return the number of ratings of each of num_users users, about
+    num_ratings in all, following a Zipf law with the given exponent.
+
+    No user can rate more than num_movies movies; the ratings the most
+    active users would have had past that are spread over the other users,
+    still in proportion to their Zipf weights. Every user rates at least one
+    movie.
+
+    Raise ValueError if num_ratings is more than num_users * num_movies.
+
+    >>> user_counts(3, 4, 9)
+    [4, 3, 2]
+    >>> user_counts(2, 5, 10)
+    [5, 5]
+    """
+    if num_ratings > num_users * num_movies:
+        raise ValueError('{} users cannot rate {} movies {} times'.format(
+            num_users, num_movies, num_ratings))
+    weights = [1.0 / user ** exponent for user in range(1, num_users + 1)]
+    # The most active users are first; cap them until the rest fit.
+    capped = 0
+    rest = sum(weights)
+    scale = num_ratings / rest
+    while capped < num_users and weights[capped] * scale > num_movies:
+        rest -= weights[capped]
+        capped += 1
+        scale = (num_ratings - capped * num_movies) / rest if rest else 0.0
+    return [num_movies] * capped + \
+        [min(num_movies, max(1, round(weight * scale)))
+         for weight in weights[capped:]]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the value below which fraction of values fall, by the nearest
+    rank method.
+
+    >>> percentile([5.0, 1.0, 3.0, 2.0, 4.0], 0.5)
+    3.0
+    >>> percentile([5.0, 1.0, 3.0, 2.0, 4.0], 0.99)
+    5.0
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * fraction // 1))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss() -> Optional[int]:
+    """Return the peak resident set size of this process in bytes, or None
+    where it is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _latencies(calls: List[Callable[[], object]]) -> Dict[str, float]:
+    """Time each call in calls and return their throughput and p50/p99
+    latency in seconds.
+    """
+    seconds = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+    total = sum(seconds)
+    return {'calls': len(seconds),
+            'per_second': len(seconds) / total if total else 0.0,
+            'p50': percentile(seconds, 0.5),
+            'p99': percentile(seconds, 0.99)}
+
+
+def run_benchmark(movie_path: str, rating_path: str, num_queries: int = 100,
+                  num_movies: int = 10, seed: int = 148) -> Dict[str, object]:
+    """Return timings of each recommender stage on the given files.
+
+    Targets are the ratings of num_queries users picked at random from the
+    ratings file.
+    """
+    results = {'movie_file': movie_path, 'rating_file': rating_path}
+    with open(movie_path) as movie_file:
+        movies = read_movies(movie_file)
+
+    start = time.perf_counter()
+    with open(rating_path) as rating_file:
+        user_ratings = read_ratings(rating_file)
+    seconds = time.perf_counter() - start
+    num_ratings = sum(len(user_ratings[user]) for user in user_ratings)
+    results['read_ratings'] = {'seconds': seconds, 'ratings': num_ratings,
+                               'per_second': num_ratings / seconds}
+    remove_unknown_movies(user_ratings, movies)
+
+    start = time.perf_counter()
+    movie_users = movies_to_users(user_ratings)
+    seconds = time.perf_counter() - start
+    results['movies_to_users'] = {'seconds': seconds,
+                                  'per_second': num_ratings / seconds}
+
+    targets = _targets(user_ratings, num_queries, seed)
+    similar = [get_similar_users(target, user_ratings, movie_users)
+               for target in targets]
+
+    results['get_similar_users'] = _latencies(
+        [_bind(get_similar_users, target, user_ratings, movie_users)
+         for target in targets])
+    results['get_movie_score'] = _latencies(
+        [_bind(get_movie_score, sim, target, user_ratings, movie_users)
+         for sim, target in zip(similar, targets)])
+    results['recommend_movies'] = _latencies(
+        [_bind(recommend_movies, target, movies, user_ratings, movie_users,
+               num_movies) for target in targets])
+    results['peak_rss'] = peak_rss()
+    return results
+
+
+def _bind(function: Callable, *args) -> Callable[[], object]:
+    """Return a function that calls function with args.
+    """
+    return lambda: function(*args)
+
+
+def measure_pruning(movie_path: str, rating_path: str,
+                    caps: List[int] = (10, 50, 200, 1000),
+                    min_similarity: Optional[float] = None,
+                    num_queries: int = 100, num_movies: int = 10,
+                    seed: int = 148) -> Dict[str, object]:
+    """Return, for each cap in caps, the latency of recommend_movies with
+    max_neighbours=cap and min_similarity, and how its recommendations
+    compare to those of recommend_movies without pruning.
+
+    overlap is the mean fraction of the unpruned recommendations that are
+    also recommended with pruning, and exact is the fraction of queries whose
+    recommendations are the same list. Targets are picked as in
+    run_benchmark.
+    """
+    movies, user_ratings, movie_users = _load(movie_path, rating_path)
+    targets = _targets(user_ratings, num_queries, seed)
+
+    expected = [recommend_movies(target, movies, user_ratings, movie_users,
+                                 num_movies) for target in targets]
+    neighbours = [len(get_similar_users(target, user_ratings, movie_users))
+                  for target in targets]
+    results = {'unpruned': _latencies(
+        [_bind(recommend_movies, target, movies, user_ratings, movie_users,
+               num_movies) for target in targets])}
+    results['unpruned']['neighbours'] = sum(neighbours) / len(neighbours)
+    for cap in caps:
+        calls = [_bind(recommend_movies, target, movies, user_ratings,
+                       movie_users, num_movies, None, cap, min_similarity)
+                 for target in targets]
+        report = _latencies(calls)
+        overlap = 0.0
+        exact = 0
+        for call, full in zip(calls, expected):
+            pruned = call()
+            if pruned == full:
+                exact += 1
+            if full:
+                overlap += len(set(pruned) & set(full)) / len(full)
+            else:
+                overlap += 1.0
+        report['overlap'] = overlap / len(targets)
+        report['exact'] = exact / len(targets)
+        report['p50_ratio'] = report['p50'] / results['unpruned']['p50']
+        results['cap_{}'.format(cap)] = report
+    return results
+
+
+def measure_ann(movie_path: str, rating_path: str,
+                settings: List[Tuple[int, int]] = ((16, 4), (32, 2), (64, 1)),
+                num_queries: int = 100, num_users: int = 20,
+                seed: int = 148) -> Dict[str, object]:
+    """Return, for each (num_bands, rows_per_band) in settings, the seconds
+    to build a MinHashIndex and its measure_recall of the num_users most
+    similar users, against top_similar_users. Targets are picked as in
+    run_benchmark.
+    """
+    _, user_ratings, movie_users = _load(movie_path, rating_path)
+    targets = _targets(user_ratings, num_queries, seed)
+    results = {}
+    for num_bands, rows_per_band in settings:
+        start = time.perf_counter()
+        index = MinHashIndex(user_ratings, num_bands, rows_per_band, seed)
+        report = {'build_seconds': time.perf_counter() - start}
+        report.update(measure_recall(index, targets, user_ratings,
+                                     movie_users, num_users))
+        report['latency_ratio'] = \
+            report['approx_seconds'] / report['exact_seconds']
+        results['{}x{}'.format(num_bands, rows_per_band)] = report
+    return results
+
+
+def _load(movie_path: str, rating_path: str) -> Tuple[Dict, Dict, Dict]:
+    """Return the movies, the ratings with unknown movies removed, and the
+    movie to users index of the given files.
+    """
+    with open(movie_path) as movie_file:
+        movies = read_movies(movie_file)
+    with open(rating_path) as rating_file:
+        user_ratings = read_ratings(rating_file)
+    remove_unknown_movies(user_ratings, movies)
+    return movies, user_ratings, movies_to_users(user_ratings)
+
+
+def _targets(user_ratings: Dict, num_queries: int,
+             seed: int) -> List[Dict[int, float]]:
+    """Return the ratings of num_queries users picked at random.
+    """
+    rand = random.Random(seed)
+    users = sorted(user_ratings)
+    return [dict(user_ratings[user])
+            for user in rand.sample(users, min(num_queries, len(users)))]
+
+
+def compare_results(results: Dict[str, object], baseline: Dict[str, object],
+                    tolerance: float = 0.1) -> Dict[str, Dict[str, float]]:
+    """Return, for every stage in both results and baseline, the ratio of
+    each timing in results to the baseline, and whether it regressed by
+    more than tolerance.
+
+    Higher is worse for seconds and latencies, lower is worse for
+    per_second.
+
+    >>> compare_results({'x': {'p50': 2.0, 'per_second': 5.0}},
+    ...                 {'x': {'p50': 1.0, 'per_second': 10.0}})
+    {'x': {'p50': 2.0, 'per_second': 0.5, 'regressed': True}}
+    """
+    report = {}
+    for stage in results:
+        if not isinstance(results[stage], dict) \
+                or not isinstance(baseline.get(stage), dict):
+            continue
+        ratios = {}
+        regressed = False
+        for metric in ('seconds', 'p50', 'p99', 'per_second'):
+            old = baseline[stage].get(metric)
+            new = results[stage].get(metric)
+            if not old or new is None:
+                continue
+            ratios[metric] = new / old
+            if metric == 'per_second':
+                regressed = regressed or ratios[metric] < 1 - tolerance
+            else:
+                regressed = regressed or ratios[metric] > 1 + tolerance
+        ratios['regressed'] = regressed
+        report[stage] = ratios
+    return report
+
+
+def main(argv: List[str] = None) -> None:
+    """Run the command line interface.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='write synthetic CSVs')
+    generate.add_argument('directory')
+    generate.add_argument('--users', type=int, default=1000)
+    generate.add_argument('--movies', type=int, default=2000)
+    generate.add_argument('--ratings', type=int, default=100000)
+    generate.add_argument('--exponent', type=float, default=1.0)
+    generate.add_argument('--seed', type=int, default=148)
+    run = commands.add_parser('run', help='time the recommender stages')
+    run.add_argument('directory')
+    run.add_argument('--queries', type=int, default=100)
+    run.add_argument('--num-movies', type=int, default=10)
+    run.add_argument('--output')
+    run.add_argument('--baseline')
+    prune = commands.add_parser('prune', help='measure neighbour pruning')
+    prune.add_argument('directory')
+    prune.add_argument('--caps', type=int, nargs='+',
+                       default=[10, 50, 200, 1000])
+    prune.add_argument('--min-similarity', type=float)
+    prune.add_argument('--queries', type=int, default=100)
+    prune.add_argument('--num-movies', type=int, default=10)
+    prune.add_argument('--output')
+    recall = commands.add_parser('recall',
+                                 help='measure MinHash index recall')
+    recall.add_argument('directory')
+    recall.add_argument('--settings', nargs='+', default=['16x4', '32x2',
+                                                          '64x1'],
+                        help='num_bands x rows_per_band, e.g. 32x2')
+    recall.add_argument('--queries', type=int, default=100)
+    recall.add_argument('--num-users', type=int, default=20)
+    recall.add_argument('--output')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        try:
+            paths = generate_dataset(args.directory, args.users, args.movies,
+                                     args.ratings, args.exponent, args.seed)
+        except ValueError as error:
+            parser.error(str(error))
+        print('\n'.join(paths))
+        return
+    movie_path = os.path.join(args.directory, 'movies.csv')
+    rating_path = os.path.join(args.directory, 'ratings.csv')
+    if args.command == 'recall':
+        settings = [tuple(int(part) for part in setting.split('x'))
+                    for setting in args.settings]
+        results = measure_ann(movie_path, rating_path, settings,
+                              args.queries, args.num_users)
+    elif args.command == 'prune':
+        results = measure_pruning(movie_path, rating_path, args.caps,
+                                  args.min_similarity, args.queries,
+                                  args.num_movies)
+    else:
+        results = run_benchmark(movie_path, rating_path, args.queries,
+                                args.num_movies)
+    if args.command == 'run' and args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            results['comparison'] = compare_results(
+                results, json.load(baseline_file))
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
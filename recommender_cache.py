@@ -0,0 +1,176 @@
+"""A bounded cache of recommend_movies results.
+
+Returning users whose ratings have not changed ask for the same
+recommendations again and again. A RecommendationCache serves one dataset --
+the movies, user_ratings and movie_users it was made with -- and keeps recent
+results keyed by a fingerprint of the target's ratings, num_movies and the
+data version they were computed at. It evicts the least recently used entries
+once the cache goes over its byte budget. Entries can also expire after a
+time to live.
+
+The whole cache is dropped when recommender_functions.get_data_version()
+changes, i.e. after ratings are loaded or after remove_unknown_movies,
+add_ratings or remove_ratings.
+"""
+
+import hashlib
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from recommender_constants import MovieDict, Rating, UserRatingDict, \
+    MovieUserDict
+from recommender_functions import recommend_movies, get_data_version
+
+# Rough per-entry bookkeeping cost in bytes: the OrderedDict slot, the key
+# tuple and the entry tuple.
+ENTRY_OVERHEAD = 200
+
+
+def rating_fingerprint(target_rating: Rating) -> bytes:
+    """Return a 16 byte digest of the ratings in target_rating that does not
+    depend on their order.
+
+    >>> first = rating_fingerprint({1: 4.0, 2: 3.5})
+    >>> first == rating_fingerprint({2: 3.5, 1: 4.0})
+    True
+    >>> rating_fingerprint({1: 4.0}) == rating_fingerprint({1: 4.5})
+    False
+    """
+    items = sorted((movie, float(target_rating[movie]))
+                   for movie in target_rating)
+    return hashlib.blake2b(repr(items).encode('ascii'),
+                           digest_size=16).digest()
+
+
+class RecommendationCache:
+    """An LRU cache of recommend_movies results for one dataset, with a byte
+    budget.
+
+    === Public Attributes ===
+    max_bytes: the most bytes the cached entries may use, roughly
+    ttl: the seconds an entry stays valid, or None for no limit
+    hits: the number of lookups answered from the cache
+    misses: the number of lookups that had to call recommend_movies
+    evictions: the number of entries removed to stay within max_bytes or
+        because they expired
+    invalidations: the number of times the cache was dropped because the
+        ratings changed
+
+    === Private Attributes ===
+    _movies, _user_ratings, _movie_users: the dataset results come from
+    _max_neighbours, _min_similarity: how recommend_movies prunes similar
+        users for this cache
+    _entries: key to (result, size in bytes, expiry time), least recently
+        used first
+    _bytes: the total size of the entries
+    _version: the data version the entries were computed at
+
+    >>> ratings = {1: {10: 4.0, 11: 5.0}}
+    >>> cache = RecommendationCache({}, ratings, {10: [1], 11: [1]},
+    ...                             max_bytes=10000)
+    >>> cache.recommend({10: 4.5}, 2)
+    [11]
+    >>> cache.recommend({10: 4.5}, 2)
+    [11]
+    >>> cache.stats()['hits'], cache.stats()['misses']
+    (1, 1)
+    """
+    max_bytes: int
+    ttl: Optional[float]
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    _entries: OrderedDict
+    _bytes: int
+    _version: int
+
+    def __init__(self, movies: MovieDict, user_ratings: UserRatingDict,
+                 movie_users: MovieUserDict,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 ttl: Optional[float] = None,
+                 max_neighbours: Optional[int] = None,
+                 min_similarity: Optional[float] = None) -> None:
+        """Initialize an empty cache of recommendations from movies,
+        user_ratings and movie_users that holds about max_bytes of results
+        for at most ttl seconds each. max_neighbours and min_similarity are
+        passed on to recommend_movies.
+        """
+        self._movies = movies
+        self._user_ratings = user_ratings
+        self._movie_users = movie_users
+        self._max_neighbours = max_neighbours
+        self._min_similarity = min_similarity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = get_data_version()
+
+    def recommend(self, target_rating: Rating, num_movies: int) -> List[int]:
+        """Return recommend_movies(target_rating, movies, user_ratings,
+        movie_users, num_movies) for this cache's dataset and pruning, from
+        the cache if possible.
+        """
+        if self._version != get_data_version():
+            self.invalidations += 1
+            self.clear()
+            self._version = get_data_version()
+        key = (rating_fingerprint(target_rating), num_movies, self._version)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[2] is None or entry[2] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[0])
+            self._remove(key)
+            self.evictions += 1
+
+        self.misses += 1
+        result = recommend_movies(target_rating, self._movies,
+                                  self._user_ratings, self._movie_users,
+                                  num_movies, None, self._max_neighbours,
+                                  self._min_similarity)
+        self._add(key, tuple(result), now)
+        return result
+
+    def _add(self, key: Tuple, result: Tuple[int, ...], now: float) -> None:
+        """Cache result under key, evicting old entries to fit.
+        """
+        size = ENTRY_OVERHEAD + sys.getsizeof(result) \
+            + sum(sys.getsizeof(movie) for movie in result)
+        if size > self.max_bytes:
+            return
+        expiry = None if self.ttl is None else now + self.ttl
+        self._entries[key] = (result, size, expiry)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple) -> None:
+        """Remove the entry under key.
+        """
+        self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self) -> None:
+        """Remove every entry. The counters are kept.
+        """
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return the counters and current size of this cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries), 'bytes': self._bytes}
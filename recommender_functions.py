@@ -1,12 +1,21 @@
 """CSC108 A3 recommender starter code."""
 
-from typing import TextIO, List, Dict
+import heapq
+import itertools
+import operator
+import time
+from array import array
+from bisect import bisect_left, insort
+from typing import TextIO, List, Dict, Iterator, Tuple, Callable, Sequence
 
 from recommender_constants import (MovieDict, Rating, UserRatingDict,
                                    MovieUserDict)
 from recommender_constants import (MOVIE_FILE_STR, RATING_FILE_STR,
                                    MOVIE_DICT_SMALL, USER_RATING_DICT_SMALL,
                                    MOVIE_USER_DICT_SMALL)
+from recommender_store import RatingStore, EncodedRatings, ID_TYPE, \
+    RATING_TYPE, append_rating
+from recommender_trace import StageTrace
 
 
 ############## HELPER FUNCTIONS
@@ -48,67 +57,166 @@ def get_similarity(user1: Rating, user2: Rating) -> float:
 MINIMUM_RATE = 3.5
 
 
+# Incremented whenever ratings are loaded or a function here changes a
+# UserRatingDict in place, so that cached results can tell they are out of
+# date.
+_data_version = 0
+
+# The StageTrace that recommend_movies records into, or None.
+_tracer = None
+
+
 ############## STUDENT HELPER FUNCTIONS
+def get_data_version() -> int:
+    """Return a number that changes every time ratings are loaded, or
+    remove_unknown_movies, add_ratings or remove_ratings modifies them.
+    """
+    return _data_version
+
+
+def bump_data_version() -> None:
+    """Record that some ratings have been loaded or changed.
+
+    Loaders and functions that modify ratings call this; so should any other
+    code that modifies ratings in place.
+    """
+    global _data_version
+    _data_version += 1
+
+
+def set_tracer(tracer: StageTrace = None) -> None:
+    """Make recommend_movies record the time and work of each of its stages
+    into tracer, or stop recording if tracer is None.
+    """
+    global _tracer
+    _tracer = tracer
+
+
 def get_can(similar_user_dic: Dict[int, float],
             target_rating: Rating,
             user_ratings: UserRatingDict,
-            movie_users: MovieUserDict) -> List[List]:
-    """
-    get candidate movies.
+            movie_users: MovieUserDict,
+            liked: Dict[int, List[int]] = None) -> Tuple[array, array]:
+    """Return the candidate movies for target_rating and their popularity, as
+    two parallel arrays: the ids of the movies that a similar user rated at
+    least MINIMUM_RATE and that are not in target_rating, and for each of
+    them the number of users in movie_users who rated it.
+
+    Candidates are in the order they are first found, going through the
+    similar users in order, so the result is the same on every run. liked
+    caches the movies each user rated at least MINIMUM_RATE; see
+    _liked_movies.
+
+    >>> movies, counts = get_can({1: 0.5, 2: 0.2}, {10: 4.0},
+    ...                          {1: {10: 4.0, 11: 4.0, 12: 1.0},
+    ...                           2: {12: 5.0, 11: 3.5}},
+    ...                          {10: [1], 11: [1, 2], 12: [1, 2]})
+    >>> list(movies), list(counts)
+    ([11, 12], [2, 2])
     """
-    movies2 = []
-    movies = []
+    if liked is None:
+        liked = {}
+    seen = set()
+    movies = array(ID_TYPE)
+    counts = array(ID_TYPE)
     for user in similar_user_dic:
-        for movie in user_ratings[user]:
-            if movie not in target_rating and user_ratings[user][movie] >= MINIMUM_RATE:
-                if movie not in movies2:
-                    movies2.append(movie)
-                    movies.append([movie, 0, len(movie_users[movie])])
-    return movies
+        for movie in _liked_movies(user, user_ratings, liked):
+            if movie not in seen and movie not in target_rating:
+                seen.add(movie)
+                movies.append(movie)
+                counts.append(len(movie_users[movie]))
+    return movies, counts
+
+
+def _liked_movies(user: int, user_ratings: UserRatingDict,
+                  liked: Dict[int, List[int]]) -> List[int]:
+    """Return the movies user rated at least MINIMUM_RATE, in the order of
+    their ratings, from liked if it has them and otherwise adding them to it.
+
+    >>> liked = {}
+    >>> _liked_movies(1, {1: {10: 4.0, 11: 1.0, 12: 3.5}}, liked)
+    [10, 12]
+    >>> liked
+    {1: [10, 12]}
+    """
+    if user not in liked:
+        rating = user_ratings[user]
+        liked[user] = [movie for movie in rating
+                       if rating[movie] >= MINIMUM_RATE]
+    return liked[user]
 
 
 def get_movie_score(similar_user_dic: Dict[int, float],
                     target_rating: Rating,
                     user_ratings: UserRatingDict,
-                    movie_users: MovieUserDict) -> List[List]:
+                    movie_users: MovieUserDict) -> Dict[int, float]:
+    """Return a dictionary of the candidate movies from get_can to their
+    recommendation score.
+
+    Each similar user splits their similarity score evenly over the candidate
+    movies they rated at least MINIMUM_RATE, and each share is divided by the
+    number of users who rated that movie. Only the similar users' own ratings
+    are visited, once each, and the scores are kept in a dense list indexed
+    by candidate.
+
+    >>> get_movie_score({1: 0.5, 2: 0.2}, {10: 4.0},
+    ...                 {1: {10: 4.0, 11: 4.0, 12: 1.0},
+    ...                  2: {12: 5.0, 11: 3.5}},
+    ...                 {10: [1], 11: [1, 2], 12: [1, 2]})
+    {11: 0.3, 12: 0.05}
     """
-    Return a dictionary containing all movies that might be recommanded with there score.
+    liked = {}
+    candidates, counts = get_can(similar_user_dic, target_rating,
+                                 user_ratings, movie_users, liked)
+    return _score_candidates(similar_user_dic, user_ratings,
+                             candidates, counts, liked)[0]
+
+
+def _score_candidates(similar_user_dic: Dict[int, float],
+                      user_ratings: UserRatingDict,
+                      candidates: array,
+                      counts: array,
+                      liked: Dict[int, List[int]] = None) \
+        -> Tuple[Dict[int, float], int]:
+    """Return the get_movie_score result for the candidates and counts from
+    get_can, and the number of (similar user, candidate) pairs scored.
+    liked is the cache get_can filled, if any.
     """
-    user_score = {}
-    movies = get_can(similar_user_dic, target_rating, user_ratings, movie_users)
-    for user in similar_user_dic:
-        user_score[user] = 0
-        for movie in movies:
-            if movie[0] in user_ratings[user] \
-                    and user_ratings[user][movie[0]] >= MINIMUM_RATE:
-                user_score[user] += 1
+    if liked is None:
+        liked = {}
+    pairs = 0
+    index = {}
+    for i in range(len(candidates)):
+        index[candidates[i]] = i
+    scores = [0.0] * len(candidates)
     for user in similar_user_dic:
-        for movie in movies:
-            if movie[0] in user_ratings[user] \
-                    and user_ratings[user][movie[0]] >= MINIMUM_RATE:
-                score = movie[1]
-                score += similar_user_dic[user] / \
-                         (user_score[user] * movie[2])
-                movie[1] = score
-    return movies
-
-
-def get_rank(num_movies: int, score_list: List, movie_score: Dict[int, List[int]]):
-    """
-    return movie with correct rank
-    """
-    movie_list = []
-    for score in score_list:
-        same_score = []
-        for movie in movie_score:
-            if score == movie_score[movie][0]:
-                same_score.append(movie)
-        same_score.sort()
-        if len(same_score) + len(movie_list) <= num_movies:
-            movie_list.extend(same_score)
-        else:
-            movie_list.extend(same_score[:(num_movies - len(movie_list))])
-    return movie_list
+        mine = [index[movie]
+                for movie in _liked_movies(user, user_ratings, liked)
+                if movie in index]
+        for i in mine:
+            scores[i] += similar_user_dic[user] / (len(mine) * counts[i])
+        pairs += len(mine)
+    movie_score = {}
+    for i in range(len(candidates)):
+        movie_score[candidates[i]] = scores[i]
+    return movie_score, pairs
+
+
+def get_top_movies(movie_scores: Dict[int, float],
+                   num_movies: int) -> List[int]:
+    """Return the ids of the num_movies movies with the highest scores in
+    movie_scores, highest score first. Movies with the same score are ordered
+    by increasing movie id.
+
+    Only a heap of num_movies entries is kept, instead of sorting every
+    candidate.
+
+    >>> get_top_movies({5: 0.5, 3: 0.9, 4: 0.5, 1: 0.1}, 3)
+    [3, 4, 5]
+    """
+    best = heapq.nsmallest(num_movies, ((-movie_scores[movie], movie)
+                                        for movie in movie_scores))
+    return [movie for _, movie in best]
 
 
 ############## STUDENT FUNCTIONS
@@ -130,7 +238,8 @@ def read_movies(movie_file: TextIO) -> MovieDict:
     True
     """
     dic = {}
-    for line in movie_file.readlines()[1:]:
+    movie_file.readline()
+    for line in movie_file:
         line = line.strip('\n')
         movie_list = line.split(',')
         id = movie_list[0]
@@ -154,13 +263,9 @@ def read_ratings(rating_file: TextIO) -> UserRatingDict:
     >>> ratings[2]
     {10: 4.0, 17: 5.0}
     """
+    bump_data_version()
     dic = {}
-    for line in rating_file.readlines()[1:]:
-        line = line.strip('\n')
-        rating_list = line.split(',')
-        id = int(rating_list[0])
-        movie = int(rating_list[1])
-        rate = float(rating_list[2])
+    for id, movie, rate in iter_ratings(rating_file):
         if id in dic:
             new_dic = dic[id]
             new_dic[movie] = rate
@@ -170,12 +275,122 @@ def read_ratings(rating_file: TextIO) -> UserRatingDict:
     return dic
 
 
+def iter_ratings(rating_file: TextIO,
+                 report: Callable[[int, float], None] = None,
+                 report_every: int = 1000000) -> Iterator[Tuple[int, int, float]]:
+    """Yield (user id, movie id, rating) for each rating in rating_file,
+    skipping the header line.
+
+    The file is read one line at a time, so memory use does not grow with the
+    size of the file. If report is given, it is called with the number of rows
+    read so far and the rows per second every report_every rows and once at
+    the end.
+
+    >>> from io import StringIO
+    >>> list(iter_ratings(StringIO('userId,movieId,rating\\n1,10,4.5\\n')))
+    [(1, 10, 4.5)]
+    """
+    rows = 0
+    start = time.perf_counter()
+    rating_file.readline()
+    for line in rating_file:
+        line = line.strip('\n')
+        if line == '':
+            continue
+        rating_list = line.split(',')
+        yield int(rating_list[0]), int(rating_list[1]), float(rating_list[2])
+        rows += 1
+        if report is not None and rows % report_every == 0:
+            report(rows, rows / max(time.perf_counter() - start, 1e-9))
+    if report is not None:
+        report(rows, rows / max(time.perf_counter() - start, 1e-9))
+
+
+def report_progress(rows: int, rows_per_second: float) -> None:
+    """Print the ingest progress of iter_ratings.
+
+    >>> report_progress(2000000, 512345.6)
+    2000000 rows read, 512346 rows/sec
+    """
+    print('{} rows read, {:.0f} rows/sec'.format(rows, rows_per_second))
+
+
+def read_rating_store(rating_file: TextIO,
+                      report: Callable[[int, float], None] = None,
+                      report_every: int = 1000000) -> RatingStore:
+    """Return a RatingStore of the user movie ratings in rating_file.
+
+    The store holds the same ratings as read_ratings(rating_file) in a
+    fraction of the memory, and can be passed anywhere a UserRatingDict is
+    read. Use store.movie_users in place of movies_to_users(store).
+
+    The file is streamed through iter_ratings straight into the store's
+    arrays; report and report_every are passed on to it, e.g. use
+    report_progress to print rows/sec while loading. Raise ValueError if a
+    rating cannot be stored exactly in the store, as with RatingStore.
+
+    >>> rating_file = open('ratings_tiny.csv')
+    >>> store = read_rating_store(rating_file)
+    >>> rating_file.close()
+    >>> len(store)
+    2
+    >>> store[1] == {2968: 1.0, 3671: 3.0}
+    True
+    """
+    bump_data_version()
+    users = array(ID_TYPE)
+    movies = array(ID_TYPE)
+    rates = array(RATING_TYPE)
+    for user, movie, rate in iter_ratings(rating_file, report, report_every):
+        users.append(user)
+        movies.append(movie)
+        append_rating(rates, rate)
+    return RatingStore.from_columns(users, movies, rates)
+
+
+def get_user_norms(user_ratings: UserRatingDict) -> Dict[int, float]:
+    """Return a dictionary of user ids to the sum of the squares of their
+    ratings in user_ratings.
+
+    Build this once after loading the ratings and pass it to
+    get_similar_users so the norms are not recomputed on every request, and
+    to add_ratings, remove_ratings and remove_unknown_movies so it is kept up
+    to date. Ratings changed any other way must not be scored with it until
+    it is rebuilt. A RatingStore, which cannot be changed in place, keeps the
+    same numbers in store.user_norms.
+
+    >>> get_user_norms({1: {10: 3.0, 11: 4.0}, 2: {10: 0.5}})
+    {1: 25.0, 2: 0.25}
+    """
+    norms = {}
+    for user in user_ratings:
+        rating = user_ratings[user]
+        norm = 0.0
+        for m_id in rating:
+            norm = norm + rating[m_id] ** 2
+        norms[user] = norm
+    return norms
+
+
+def _norms_of(user_ratings: UserRatingDict,
+              user_norms: Dict[int, float]) -> Dict[int, float]:
+    """Return user_norms, or if it is None, the norms user_ratings carries
+    if it is a read-only store such as a RatingStore, which may also be None.
+    """
+    if user_norms is None:
+        return getattr(user_ratings, 'user_norms', None)
+    return user_norms
+
+
 def remove_unknown_movies(user_ratings: UserRatingDict,
-                          movies: MovieDict) -> None:
+                          movies: MovieDict,
+                          user_norms: Dict[int, float] = None) -> None:
     """Modify the user_ratings dictionary so that only movie ids that are in the
     movies dictionary is remaining. Remove any users in user_ratings that have
     no movies rated.
 
+    If user_norms from get_user_norms is given, it is updated to match.
+
     >>> small_ratings = {1001: {68735: 5.0, 302156: 3.5, 10: 4.5}, 1002: {11: 3.0}}
     >>> remove_unknown_movies(small_ratings, MOVIE_DICT_SMALL)
     >>> len(small_ratings)
@@ -185,6 +400,7 @@ def remove_unknown_movies(user_ratings: UserRatingDict,
     >>> 1002 in small_ratings
     False
     """
+    bump_data_version()
     need_user = []
     for user in user_ratings:
         dic = user_ratings[user]
@@ -196,8 +412,12 @@ def remove_unknown_movies(user_ratings: UserRatingDict,
             del dic[movie]
         if user_ratings[user] == {}:
             need_user.append(user)
+        elif need_movie != [] and user_norms is not None:
+            user_norms[user] = get_user_norms({user: dic})[user]
     for user in need_user:
         del user_ratings[user]
+        if user_norms is not None and user in user_norms:
+            del user_norms[user]
 
 
 def movies_to_users(user_ratings: UserRatingDict) -> MovieUserDict:
@@ -205,12 +425,17 @@ def movies_to_users(user_ratings: UserRatingDict) -> MovieUserDict:
     using information from the user_ratings dictionary of users to movie
     ratings dictionaries.
 
+    Each list of users is in increasing order, which lets
+    get_users_who_watched merge them.
+
     >>> result = movies_to_users(USER_RATING_DICT_SMALL)
     >>> result == MOVIE_USER_DICT_SMALL
     True
+    >>> movies_to_users({2: {10: 3.0}, 1: {10: 3.5}})
+    {10: [1, 2]}
     """
     dic = {}
-    for user in user_ratings:
+    for user in sorted(user_ratings):
         user_dic = user_ratings[user]
         for movie in user_dic:
             if movie in dic:
@@ -220,48 +445,275 @@ def movies_to_users(user_ratings: UserRatingDict) -> MovieUserDict:
     return dic
 
 
+def compact_movie_users(movie_users: MovieUserDict) -> MovieUserDict:
+    """Return a copy of movie_users with each list of users stored as a
+    sorted typed array, which takes 4 bytes per user instead of a list slot
+    and an int object.
+
+    The result can be used anywhere movie_users can, including add_ratings
+    and remove_ratings.
+
+    >>> compact = compact_movie_users({10: [2, 1], 11: [3]})
+    >>> compact[10]
+    array('i', [1, 2])
+    """
+    compact = {}
+    for movie in movie_users:
+        compact[movie] = array(ID_TYPE, sorted(movie_users[movie]))
+    return compact
+
+
+def add_ratings(new_ratings: UserRatingDict,
+                user_ratings: UserRatingDict,
+                movie_users: MovieUserDict,
+                user_norms: Dict[int, float] = None) -> None:
+    """Modify user_ratings, movie_users and, if given, user_norms to include
+    the ratings in new_ratings. A new rating of a movie the user already
+    rated replaces the old one.
+
+    Only the users and movies in new_ratings are touched: each new rating is
+    inserted into its movie's user list, which keeps lists in increasing
+    user order, and the norm of each touched user is recomputed from that
+    user's ratings. Movie popularity is the length of the movie's user list,
+    so it stays up to date as well. Users with no new ratings are skipped,
+    so that, as after remove_unknown_movies, no user is left with none.
+
+    >>> user_ratings = {1: {10: 3.0}}
+    >>> movie_users = movies_to_users(user_ratings)
+    >>> add_ratings({1: {10: 4.0, 11: 2.0}, 2: {10: 5.0}},
+    ...             user_ratings, movie_users)
+    >>> user_ratings
+    {1: {10: 4.0, 11: 2.0}, 2: {10: 5.0}}
+    >>> movie_users
+    {10: [1, 2], 11: [1]}
+    """
+    bump_data_version()
+    for user in new_ratings:
+        if len(new_ratings[user]) == 0:
+            continue
+        if user not in user_ratings:
+            user_ratings[user] = {}
+        rating = user_ratings[user]
+        for movie in new_ratings[user]:
+            if movie not in rating:
+                if movie not in movie_users:
+                    movie_users[movie] = []
+                insort(movie_users[movie], user)
+            rating[movie] = new_ratings[user][movie]
+        if user_norms is not None:
+            user_norms[user] = get_user_norms({user: rating})[user]
+
+
+def remove_ratings(old_ratings: Dict[int, List[int]],
+                   user_ratings: UserRatingDict,
+                   movie_users: MovieUserDict,
+                   user_norms: Dict[int, float] = None) -> None:
+    """Modify user_ratings, movie_users and, if given, user_norms to remove
+    the ratings in old_ratings, a dictionary of user id to the movie ids
+    whose ratings to remove. Ratings that do not exist are ignored.
+
+    As in remove_unknown_movies, users left with no ratings are removed, and
+    so are movies left with no users.
+
+    >>> user_ratings = {1: {10: 3.0, 11: 2.0}, 2: {10: 5.0}}
+    >>> movie_users = movies_to_users(user_ratings)
+    >>> remove_ratings({1: [11], 2: [10, 12]}, user_ratings, movie_users)
+    >>> user_ratings
+    {1: {10: 3.0}}
+    >>> movie_users
+    {10: [1]}
+    """
+    bump_data_version()
+    for user in old_ratings:
+        if user not in user_ratings:
+            continue
+        rating = user_ratings[user]
+        for movie in old_ratings[user]:
+            if movie not in rating:
+                continue
+            del rating[movie]
+            users = movie_users[movie]
+            i = bisect_left(users, user)
+            if i < len(users) and users[i] == user:
+                del users[i]
+            else:
+                users.remove(user)
+            if len(users) == 0:
+                del movie_users[movie]
+        if rating == {}:
+            del user_ratings[user]
+            if user_norms is not None and user in user_norms:
+                del user_norms[user]
+        elif user_norms is not None:
+            user_norms[user] = get_user_norms({user: rating})[user]
+
+
 def get_users_who_watched(movie_ids: List[int],
                           movie_users: MovieUserDict) -> List[int]:
     """Return the list of user ids in moive_users who watched at least one
     movie in moive_ids.
 
+    When the lists of users are in increasing order, as movies_to_users,
+    compact_movie_users and add_ratings keep them, they are combined by a
+    k-way merge, so no combined copy is built, sorted or deduplicated
+    through a set. Otherwise the users are gathered in a set and sorted.
+
     >>> get_users_who_watched([293660], MOVIE_USER_DICT_SMALL)
     [2]
     >>> lst = get_users_who_watched([68735, 302156], MOVIE_USER_DICT_SMALL)
     >>> len(lst)
     2
+    >>> get_users_who_watched([1, 2], {1: [3, 1], 2: [1, 2]})
+    [1, 2, 3]
     """
-    user_list = []
+    lists = []
     for movie in movie_ids:
         if movie in movie_users:
-            user_list.extend(movie_users[movie])
-    user_list_set = set(user_list)
-    user_list = list(user_list_set)
-    user_list.sort()
+            lists.append(movie_users[movie])
+    if not all(map(_is_increasing, lists)):
+        user_set = set()
+        for users in lists:
+            user_set.update(users)
+        return sorted(user_set)
+    user_list = []
+    for user in heapq.merge(*lists):
+        if len(user_list) == 0 or user_list[-1] != user:
+            user_list.append(user)
     return user_list
 
 
+def _is_increasing(users: Sequence[int]) -> bool:
+    """Return whether users is in non-decreasing order.
+
+    >>> _is_increasing([1, 4, 9]), _is_increasing([3, 1])
+    (True, False)
+    """
+    return all(map(operator.le, users, itertools.islice(users, 1, None)))
+
+
+def get_shared_scores(target_rating: Rating,
+                      user_ratings: UserRatingDict,
+                      movie_users: MovieUserDict,
+                      postings: Dict[int, List[Tuple[int, float]]] = None) \
+        -> Dict[int, float]:
+    """Return a dictionary of user ids to the dot product of their ratings and
+    target_rating, for every user in movie_users who rated at least one movie
+    in target_rating.
+
+    All candidate users are scored in one pass over the posting lists of the
+    target's movies, instead of one get_similarity call per user. The products
+    are added in the order of target_rating, the same order get_similarity
+    adds them in, so the sums are identical.
+
+    If postings is given, it caches the (user id, rating) pairs of each
+    movie's posting list, so targets that share movies look them up once.
+
+    >>> get_shared_scores({68735: 2.0}, {1: {68735: 3.5}, 2: {68735: 1.0}},
+    ...                   {68735: [1, 2]})
+    {1: 7.0, 2: 2.0}
+    """
+    shared = {}
+    for m_id in target_rating:
+        if m_id in movie_users:
+            target_rate = target_rating[m_id]
+            if postings is None:
+                for user in movie_users[m_id]:
+                    shared[user] = shared.get(user, 0.0) + \
+                        target_rate * user_ratings[user][m_id]
+                continue
+            if m_id not in postings:
+                postings[m_id] = [(user, user_ratings[user][m_id])
+                                  for user in movie_users[m_id]]
+            for user, rate in postings[m_id]:
+                shared[user] = shared.get(user, 0.0) + target_rate * rate
+    return shared
+
+
 def get_similar_users(target_rating: Rating,
                       user_ratings: UserRatingDict,
-                      movie_users: MovieUserDict) -> Dict[int, float]:
+                      movie_users: MovieUserDict,
+                      user_norms: Dict[int, float] = None,
+                      max_neighbours: int = None,
+                      min_similarity: float = None) -> Dict[int, float]:
     """Return a dictionary of similar user ids to similarity scores between the
     similar user's movie rating in user_ratings dictionary and the
     target_rating. Only return similarites for similar users who has at least
     one rating in movie_users dictionary that appears in target_Ratings.
 
+    user_norms maps user ids to the sum of their squared ratings, as built by
+    get_user_norms. If it is not given, the user_norms of a RatingStore (or
+    any read-only user_ratings that has them) are used, and for a plain
+    dictionary they are computed for each similar user, as they are for a
+    user missing from user_norms.
+
+    If min_similarity is given, users with a lower score are left out. If
+    max_neighbours is given, only that many users with the highest scores
+    are kept, ties going to the smaller user id. See prune_similar_users.
+
     >>> sim = get_similar_users({293660: 4.5}, USER_RATING_DICT_SMALL, MOVIE_USER_DICT_SMALL)
     >>> len(sim)
     1
     >>> round(sim[2], 2)
     0.86
+    >>> get_similar_users({10: 4.0}, {1: {10: 4.0}, 2: {10: 2.0, 11: 4.0}},
+    ...                   {10: [1, 2], 11: [2]}, max_neighbours=1)
+    {1: 1.0}
+    """
+    shared = get_shared_scores(target_rating, user_ratings, movie_users)
+    similar = _similarities(shared, target_rating, user_ratings, user_norms)
+    return prune_similar_users(similar, max_neighbours, min_similarity)
+
+
+def prune_similar_users(similar_user_dic: Dict[int, float],
+                        max_neighbours: int = None,
+                        min_similarity: float = None) -> Dict[int, float]:
+    """Return the users in similar_user_dic with a score of at least
+    min_similarity, and of those only the max_neighbours with the highest
+    scores, ties going to the smaller user id. Either limit may be None.
+
+    The kept users stay in the order of similar_user_dic, so get_movie_score
+    adds up their shares in the same order as without pruning. Only a heap
+    of max_neighbours entries is kept, instead of sorting every user.
+
+    >>> prune_similar_users({1: 0.2, 2: 0.9, 3: 0.5, 4: 0.9}, 2)
+    {2: 0.9, 4: 0.9}
+    >>> prune_similar_users({1: 0.2, 2: 0.9, 3: 0.5}, min_similarity=0.4)
+    {2: 0.9, 3: 0.5}
     """
-    movie_list = []
-    for key in target_rating:
-        movie_list.append(key)
-    similar_user = get_users_who_watched(movie_list, movie_users)
+    if min_similarity is not None:
+        similar_user_dic = {user: similar_user_dic[user]
+                            for user in similar_user_dic
+                            if similar_user_dic[user] >= min_similarity}
+    if max_neighbours is not None and len(similar_user_dic) > max_neighbours:
+        best = heapq.nsmallest(max_neighbours,
+                               ((-similar_user_dic[user], user)
+                                for user in similar_user_dic))
+        kept = {user for _, user in best}
+        similar_user_dic = {user: similar_user_dic[user]
+                            for user in similar_user_dic if user in kept}
+    return similar_user_dic
+
+
+def _similarities(shared: Dict[int, float],
+                  target_rating: Rating,
+                  user_ratings: UserRatingDict,
+                  user_norms: Dict[int, float] = None) -> Dict[int, float]:
+    """Return the get_similar_users result for the dot products in shared
+    from get_shared_scores.
+    """
+    norm1 = 0.0
+    for m_id in target_rating:
+        norm1 = norm1 + target_rating[m_id] ** 2
+    user_norms = _norms_of(user_ratings, user_norms)
     dic = {}
-    for user in similar_user:
-        dic[user] = get_similarity(target_rating, user_ratings[user])
+    for user in sorted(shared):
+        norm2 = None if user_norms is None else user_norms.get(user)
+        if norm2 is None:
+            rating = user_ratings[user]
+            norm2 = 0.0
+            for m_id in rating:
+                norm2 = norm2 + rating[m_id] ** 2
+        dic[user] = (shared[user] * shared[user]) / (norm1 * norm2)
     return dic
 
 
@@ -269,32 +721,170 @@ def recommend_movies(target_rating: Rating,
                      movies: MovieDict,
                      user_ratings: UserRatingDict,
                      movie_users: MovieUserDict,
-                     num_movies: int) -> List[int]:
+                     num_movies: int,
+                     user_norms: Dict[int, float] = None,
+                     max_neighbours: int = None,
+                     min_similarity: float = None) -> List[int]:
     """Return a list of num_movies movie id recommendations for a target user
     with target_rating of previous movies. The recommendations come from movies
     dictionary, and are based on movies that "similar users" data in
     user_ratings / movie_users dictionaries.
 
+    user_norms, max_neighbours and min_similarity are passed on to
+    get_similar_users: user_norms defaults to the norms a RatingStore
+    carries, and by default every similar user is scored.
+
     >>> recommend_movies({302156: 4.5}, MOVIE_DICT_SMALL, USER_RATING_DICT_SMALL, MOVIE_USER_DICT_SMALL, 2)
     [68735]
     >>> recommend_movies({68735: 4.5}, MOVIE_DICT_SMALL, USER_RATING_DICT_SMALL, MOVIE_USER_DICT_SMALL, 2)
     [302156, 293660]
     """
-    similar_user_dic = get_similar_users(target_rating, user_ratings, movie_users)
+    if _tracer is not None:
+        return _recommend_traced(target_rating, user_ratings, movie_users,
+                                 num_movies, _tracer, user_norms,
+                                 max_neighbours, min_similarity)
+    similar_user_dic = get_similar_users(target_rating, user_ratings,
+                                         movie_users, user_norms,
+                                         max_neighbours, min_similarity)
     movie_score = get_movie_score(similar_user_dic,
                                   target_rating, user_ratings, movie_users)
-    movie_list = []
-    for key in movie_score:
-        movie_list.append((key[1], key[0]))
-    new_movie = []
-    for tup in movie_list:
-        new_movie.append((-tup[0], tup[1]))
-    new_movie.sort()
-    new_movie = new_movie[:num_movies]
-    new_m = []
-    for movie in new_movie:
-        new_m.append(movie[1])
-    return new_m
+    return get_top_movies(movie_score, num_movies)
+
+
+def _recommend_traced(target_rating: Rating,
+                      user_ratings: UserRatingDict,
+                      movie_users: MovieUserDict,
+                      num_movies: int,
+                      tracer: StageTrace,
+                      user_norms: Dict[int, float] = None,
+                      max_neighbours: int = None,
+                      min_similarity: float = None) -> List[int]:
+    """Return recommend_movies(target_rating, ..., num_movies), recording the
+    time and work of each stage into tracer.
+    """
+    seconds = {}
+    start = time.perf_counter()
+    shared = get_shared_scores(target_rating, user_ratings, movie_users)
+    now = time.perf_counter()
+    seconds['fan_out'] = now - start
+    start = now
+    similar_user_dic = prune_similar_users(
+        _similarities(shared, target_rating, user_ratings, user_norms),
+        max_neighbours, min_similarity)
+    now = time.perf_counter()
+    seconds['similarity'] = now - start
+    start = now
+    liked = {}
+    candidates, counts = get_can(similar_user_dic, target_rating,
+                                 user_ratings, movie_users, liked)
+    now = time.perf_counter()
+    seconds['candidates'] = now - start
+    start = now
+    movie_score, pairs = _score_candidates(similar_user_dic, user_ratings,
+                                           candidates, counts, liked)
+    now = time.perf_counter()
+    seconds['scoring'] = now - start
+    start = now
+    result = get_top_movies(movie_score, num_movies)
+    seconds['top_k'] = time.perf_counter() - start
+    tracer.record(seconds, {'target_movies': len(target_rating),
+                            'similar_users': len(similar_user_dic),
+                            'candidates': len(candidates),
+                            'scored_pairs': pairs})
+    return result
+
+
+def recommend_movies_encoded(target_rating: Rating,
+                             movies: MovieDict,
+                             encoded: EncodedRatings,
+                             num_movies: int) -> List[int]:
+    """Return recommend_movies for target_rating over the ratings in encoded,
+    whose user and movie ids are dense indices.
+
+    target_rating and the result use external movie ids; everything in
+    between runs on indices, so the store finds users and movies by position
+    instead of by search. Because indices are in id order, the result is the
+    same as recommend_movies on RatingStore.from_dict of the same ratings.
+
+    >>> encoded = EncodedRatings.from_dict(USER_RATING_DICT_SMALL)
+    >>> recommend_movies_encoded({302156: 4.5}, MOVIE_DICT_SMALL, encoded, 2)
+    [68735]
+    """
+    store = encoded.store
+    result = recommend_movies(encoded.encode_rating(target_rating), movies,
+                              store, store.movie_users, num_movies)
+    return encoded.decode_movies(result)
+
+
+def recommend_movies_batch(targets: List[Rating],
+                           movies: MovieDict,
+                           user_ratings: UserRatingDict,
+                           movie_users: MovieUserDict,
+                           num_movies: int,
+                           user_norms: Dict[int, float] = None,
+                           block_size: int = 1024,
+                           max_neighbours: int = None,
+                           min_similarity: float = None) -> List[List[int]]:
+    """Return recommend_movies(target, movies, user_ratings, movie_users,
+    num_movies, user_norms, max_neighbours, min_similarity) for each target
+    in targets, in the same order.
+
+    Targets are handled in blocks of block_size. Within a block, the ratings
+    on each posting list and the movies each similar user rated at least
+    MINIMUM_RATE are looked up once and shared by every target that needs
+    them; the caches are dropped between blocks to bound memory. User norms
+    are looked up once for the whole batch. Each target then goes through
+    the same stages as recommend_movies, so the results are identical.
+
+    >>> recommend_movies_batch([{302156: 4.5}, {68735: 4.5}], MOVIE_DICT_SMALL, USER_RATING_DICT_SMALL, MOVIE_USER_DICT_SMALL, 2)
+    [[68735], [302156, 293660]]
+    """
+    user_norms = _LazyNorms(user_ratings, _norms_of(user_ratings, user_norms))
+    results = []
+    for start in range(0, len(targets), block_size):
+        postings = {}
+        liked = {}
+        for target_rating in targets[start:start + block_size]:
+            shared = get_shared_scores(target_rating, user_ratings,
+                                       movie_users, postings)
+            similar_user_dic = prune_similar_users(
+                _similarities(shared, target_rating, user_ratings,
+                              user_norms),
+                max_neighbours, min_similarity)
+            candidates, counts = get_can(similar_user_dic, target_rating,
+                                         user_ratings, movie_users, liked)
+            movie_score = _score_candidates(similar_user_dic, user_ratings,
+                                            candidates, counts, liked)[0]
+            results.append(get_top_movies(movie_score, num_movies))
+    return results
+
+
+class _LazyNorms:
+    """A {user id: sum of squared ratings} table filled in on first use, from
+    known norms where they have the user.
+    """
+
+    def __init__(self, user_ratings: UserRatingDict,
+                 known: Dict[int, float] = None) -> None:
+        """Initialize an empty table over user_ratings and the norms in
+        known, which may be None.
+        """
+        self._user_ratings = user_ratings
+        self._known = known
+        self._norms = {}
+
+    def get(self, user: int) -> float:
+        """Return the sum of the squared ratings of user.
+        """
+        if user not in self._norms:
+            norm = None if self._known is None else self._known.get(user)
+            if norm is None:
+                rating = self._user_ratings[user]
+                norm = 0.0
+                for m_id in rating:
+                    norm = norm + rating[m_id] ** 2
+            self._norms[user] = norm
+        return self._norms[user]
 
 
 if __name__ == '__main__':
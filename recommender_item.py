@@ -0,0 +1,158 @@
+"""Item-based recommendations from precomputed similar movies.
+
+The user-based recommend_movies finds similar users and scores their movies
+at query time. ItemNeighbours moves the heavy work offline: build() computes,
+from the ratings and movies_to_users, the num_neighbours movies most similar
+to each movie (by cosine similarity of the movies' rating vectors), and
+save() / load() keep the table in a snapshot-layout file. At query time
+ItemNeighbours.recommend_movies only looks at the neighbours of the movies
+the target rated.
+"""
+
+import heapq
+import math
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from recommender_constants import MovieDict, Rating, UserRatingDict, \
+    MovieUserDict
+from recommender_functions import get_top_movies
+from recommender_snapshot import read_columns, write_columns
+from recommender_store import ID_TYPE, NORM_TYPE, OFFSET_TYPE
+
+
+class ItemNeighbours:
+    """For each movie, the most similar other movies and their similarity.
+
+    === Public Attributes ===
+    movie_ids: the sorted movie ids that have neighbours
+    offsets: offsets[i]:offsets[i + 1] is the run of movie_ids[i] in
+        neighbour_ids and similarities
+    neighbour_ids: the neighbours of each movie, most similar first
+    similarities: the cosine similarity of each neighbour
+
+    >>> ratings = {1: {10: 5.0, 11: 5.0}, 2: {10: 4.0, 11: 4.0, 12: 1.0},
+    ...            3: {12: 5.0, 13: 4.0}}
+    >>> table = ItemNeighbours.build(ratings, {10: [1, 2], 11: [1, 2],
+    ...                                        12: [2, 3], 13: [3]}, 2)
+    >>> [movie for movie, _ in table.neighbours(10)]
+    [11, 12]
+    >>> table.recommend_movies({10: 4.5}, {}, ratings, {}, 2)
+    [11, 12]
+    """
+    movie_ids: array
+    offsets: array
+    neighbour_ids: array
+    similarities: array
+
+    # The names of the array attributes, in the order __init__ takes them.
+    COLUMNS = ('movie_ids', 'offsets', 'neighbour_ids', 'similarities')
+
+    def __init__(self, movie_ids, offsets, neighbour_ids,
+                 similarities) -> None:
+        """Initialize a table over already-built arrays.
+
+        Use build to compute the arrays from ratings.
+        """
+        self.movie_ids = movie_ids
+        self.offsets = offsets
+        self.neighbour_ids = neighbour_ids
+        self.similarities = similarities
+
+    @classmethod
+    def build(cls, user_ratings: UserRatingDict, movie_users: MovieUserDict,
+              num_neighbours: int = 50) -> 'ItemNeighbours':
+        """Return the table of the num_neighbours most similar movies to each
+        movie in movie_users. Ties go to the smaller movie id.
+
+        This visits, for every movie, every rating of every user who rated
+        it, so it is meant to run as an offline job.
+        """
+        norms = {}
+        for user in user_ratings:
+            rating = user_ratings[user]
+            for movie in rating:
+                norms[movie] = norms.get(movie, 0.0) + rating[movie] ** 2
+
+        movie_ids = array(ID_TYPE, sorted(movie_users))
+        offsets = array(OFFSET_TYPE, [0])
+        neighbour_ids = array(ID_TYPE)
+        similarities = array(NORM_TYPE)
+        for movie in movie_ids:
+            shared = {}
+            for user in movie_users[movie]:
+                rating = user_ratings[user]
+                rate = rating[movie]
+                for other in rating:
+                    if other != movie:
+                        shared[other] = shared.get(other, 0.0) + \
+                            rate * rating[other]
+            best = heapq.nsmallest(
+                num_neighbours,
+                ((-shared[other] / math.sqrt(norms[movie] * norms[other]),
+                  other) for other in shared))
+            for similarity, other in best:
+                neighbour_ids.append(other)
+                similarities.append(-similarity)
+            offsets.append(len(neighbour_ids))
+        return cls(movie_ids, offsets, neighbour_ids, similarities)
+
+    def neighbours(self, movie: int) -> List[Tuple[int, float]]:
+        """Return the (movie id, similarity) neighbours of movie, most
+        similar first, or [] if movie has none.
+        """
+        lo = bisect_left(self.movie_ids, movie)
+        if lo == len(self.movie_ids) or self.movie_ids[lo] != movie:
+            return []
+        start = self.offsets[lo]
+        end = self.offsets[lo + 1]
+        return list(zip(self.neighbour_ids[start:end],
+                        self.similarities[start:end]))
+
+    def get_movie_score(self, target_rating: Rating) -> Dict[int, float]:
+        """Return a dictionary of candidate movies to their score for
+        target_rating: the sum, over the movies the target rated, of the
+        target's rating times the candidate's similarity to that movie.
+        Movies in target_rating are not candidates.
+        """
+        scores = {}
+        for movie in target_rating:
+            rate = target_rating[movie]
+            for other, similarity in self.neighbours(movie):
+                if other not in target_rating:
+                    scores[other] = scores.get(other, 0.0) + \
+                        rate * similarity
+        return scores
+
+    def recommend_movies(self, target_rating: Rating, movies: MovieDict,
+                         user_ratings: UserRatingDict,
+                         movie_users: MovieUserDict,
+                         num_movies: int) -> List[int]:
+        """Return a list of num_movies movie id recommendations for a target
+        user with target_rating, from the precomputed neighbours of the
+        movies they rated.
+
+        Takes the same arguments as recommender_functions.recommend_movies so
+        either can serve a request; movies, user_ratings and movie_users are
+        not needed at query time.
+        """
+        return get_top_movies(self.get_movie_score(target_rating),
+                              num_movies)
+
+    def save(self, path: str) -> None:
+        """Write this table to a file at path.
+        """
+        write_columns(path, {name: getattr(self, name)
+                             for name in self.COLUMNS}, [])
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = False) -> 'ItemNeighbours':
+        """Return the table saved at path by save.
+
+        Raise ValueError if there is no readable table at path.
+        """
+        columns = read_columns(path, None, use_mmap)
+        if columns is None:
+            raise ValueError('cannot read item neighbours ' + path)
+        return cls(*[columns[name] for name in cls.COLUMNS])
@@ -0,0 +1,307 @@
+"""An offline k-nearest-neighbour graph of the users in user_ratings.
+
+Most requests come from users who are already in user_ratings, and for each
+of them recommend_movies recomputes get_similar_users from scratch.
+UserNeighbours.build runs that once per user, offline, in blocks of users
+that can be spread over worker processes, and keeps the num_neighbours most
+similar other users of each. save() / load() keep the graph in a
+snapshot-layout file that can be mapped read-only.
+
+UserNeighbours.recommend_for_user then scores a user's recommendations from
+their stored neighbours, skipping the fan-out over the posting lists of every
+movie they rated.
+
+When ratings change, affected_users gives the users whose neighbours may have
+changed, and UserNeighbours.refresh recomputes only those.
+"""
+
+import heapq
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from recommender_constants import MovieDict, UserRatingDict, MovieUserDict
+from recommender_functions import (get_similar_users, get_movie_score,
+                                   get_top_movies, get_user_norms,
+                                   recommend_movies)
+from recommender_parallel import share_ratings
+from recommender_snapshot import load_snapshot, read_columns, write_columns
+from recommender_store import ID_TYPE, NORM_TYPE, OFFSET_TYPE
+
+# The store and number of neighbours of a worker process, set by
+# _init_worker.
+_worker_store = None
+_worker_num_neighbours = None
+
+
+class UserNeighbours:
+    """For each user, the most similar other users and their similarity.
+
+    === Public Attributes ===
+    user_ids: the sorted ids of the users in the graph
+    offsets: offsets[i]:offsets[i + 1] is the run of user_ids[i] in
+        neighbour_ids and similarities
+    neighbour_ids: the neighbours of each user, in increasing order of id
+    similarities: the get_similar_users score of each neighbour
+
+    Neighbours are kept in id order, the order get_similar_users returns
+    them in, so scoring from the stored neighbours adds up exactly as
+    recommend_movies does.
+
+    >>> ratings = {1: {10: 5.0, 11: 4.0}, 2: {10: 5.0, 12: 4.0},
+    ...            3: {11: 1.0, 13: 5.0}}
+    >>> movie_users = {10: [1, 2], 11: [1, 3], 12: [2], 13: [3]}
+    >>> graph = UserNeighbours.build(ratings, movie_users, 1)
+    >>> graph.neighbours(1)
+    {2: 0.37180249851279}
+    >>> graph.recommend_for_user(1, {}, ratings, movie_users, 2)
+    [12]
+    """
+    user_ids: array
+    offsets: array
+    neighbour_ids: array
+    similarities: array
+
+    # The names of the array attributes, in the order __init__ takes them.
+    COLUMNS = ('user_ids', 'offsets', 'neighbour_ids', 'similarities')
+
+    def __init__(self, user_ids, offsets, neighbour_ids,
+                 similarities) -> None:
+        """Initialize a graph over already-built arrays.
+
+        Use build to compute the arrays from ratings.
+        """
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.neighbour_ids = neighbour_ids
+        self.similarities = similarities
+
+    @classmethod
+    def build(cls, user_ratings: UserRatingDict, movie_users: MovieUserDict,
+              num_neighbours: int = 50, processes: Optional[int] = 1,
+              block_size: int = 1024,
+              snapshot_path: str = None) -> 'UserNeighbours':
+        """Return the graph of the num_neighbours most similar other users of
+        every user in user_ratings. Ties go to the smaller user id.
+
+        Users are handled in blocks of block_size. If processes is not 1, the
+        blocks are spread over that many worker processes (one per core if
+        processes is None), which map the ratings from a snapshot written to
+        snapshot_path.
+        """
+        lists = _neighbour_lists(sorted(user_ratings), user_ratings,
+                                 movie_users, num_neighbours, processes,
+                                 block_size, snapshot_path)
+        return cls._from_lists(lists)
+
+    @classmethod
+    def _from_lists(cls, lists: Iterable[Tuple[int, array, array]]) \
+            -> 'UserNeighbours':
+        """Return the graph of the (user, neighbour ids, similarities) in
+        lists, which are in increasing order of user.
+        """
+        user_ids = array(ID_TYPE)
+        offsets = array(OFFSET_TYPE, [0])
+        neighbour_ids = array(ID_TYPE)
+        similarities = array(NORM_TYPE)
+        for user, ids, sims in lists:
+            user_ids.append(user)
+            neighbour_ids.extend(ids)
+            similarities.extend(sims)
+            offsets.append(len(neighbour_ids))
+        return cls(user_ids, offsets, neighbour_ids, similarities)
+
+    def _find(self, user: int) -> int:
+        """Return the index of user in user_ids, or -1 if it is not there.
+        """
+        i = bisect_left(self.user_ids, user)
+        if i < len(self.user_ids) and self.user_ids[i] == user:
+            return i
+        return -1
+
+    def __contains__(self, user: object) -> bool:
+        """Return whether user is in this graph.
+        """
+        return self._find(user) >= 0
+
+    def _run(self, i: int) -> Tuple[array, array]:
+        """Return the neighbour ids and similarities of user_ids[i].
+        """
+        start = self.offsets[i]
+        end = self.offsets[i + 1]
+        return self.neighbour_ids[start:end], self.similarities[start:end]
+
+    def neighbours(self, user: int) -> Dict[int, float]:
+        """Return the {neighbour id: similarity} of user, in increasing order
+        of id, or {} if user is not in this graph.
+        """
+        i = self._find(user)
+        if i < 0:
+            return {}
+        ids, sims = self._run(i)
+        return dict(zip(ids, sims))
+
+    def recommend_for_user(self, user: int, movies: MovieDict,
+                           user_ratings: UserRatingDict,
+                           movie_users: MovieUserDict,
+                           num_movies: int) -> List[int]:
+        """Return a list of num_movies movie id recommendations for user,
+        whose ratings are in user_ratings, scored from their stored
+        neighbours.
+
+        With num_neighbours at least the number of users who share a movie
+        with user, this is the same as recommend_movies(user_ratings[user],
+        ...). A user who is not in this graph gets recommend_movies, and
+        stored neighbours who no longer have ratings are skipped, so a graph
+        can keep serving between refreshes.
+        """
+        target_rating = user_ratings[user]
+        if user not in self:
+            return recommend_movies(target_rating, movies, user_ratings,
+                                    movie_users, num_movies)
+        similar = {}
+        for other, similarity in self.neighbours(user).items():
+            if other in user_ratings:
+                similar[other] = similarity
+        movie_score = get_movie_score(similar, target_rating, user_ratings,
+                                      movie_users)
+        return get_top_movies(movie_score, num_movies)
+
+    def refresh(self, users: Iterable[int], user_ratings: UserRatingDict,
+                movie_users: MovieUserDict, num_neighbours: int = 50,
+                processes: Optional[int] = 1, block_size: int = 1024,
+                snapshot_path: str = None) -> 'UserNeighbours':
+        """Return a copy of this graph with the neighbours of users
+        recomputed from the current user_ratings and movie_users, as build
+        would. Users in users that no longer have ratings are dropped; all
+        other users keep their stored neighbours.
+
+        Use affected_users to find the users to refresh after ratings change.
+        """
+        users = set(users)
+        fresh = _neighbour_lists(
+            sorted(user for user in users if user in user_ratings),
+            user_ratings, movie_users, num_neighbours, processes, block_size,
+            snapshot_path)
+        return self._from_lists(heapq.merge(self._kept(users), fresh,
+                                            key=lambda item: item[0]))
+
+    def _kept(self, users: set) -> Iterator[Tuple[int, array, array]]:
+        """Yield the (user, neighbour ids, similarities) of every user in
+        this graph who is not in users, in increasing order of user.
+        """
+        for i in range(len(self.user_ids)):
+            if self.user_ids[i] not in users:
+                ids, sims = self._run(i)
+                yield self.user_ids[i], ids, sims
+
+    def save(self, path: str) -> None:
+        """Write this graph to a file at path.
+        """
+        write_columns(path, {name: getattr(self, name)
+                             for name in self.COLUMNS}, [])
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = False) -> 'UserNeighbours':
+        """Return the graph saved at path by save.
+
+        Raise ValueError if there is no readable graph at path.
+        """
+        columns = read_columns(path, None, use_mmap)
+        if columns is None:
+            raise ValueError('cannot read user neighbours ' + path)
+        return cls(*[columns[name] for name in cls.COLUMNS])
+
+
+def affected_users(changes: Dict[int, Iterable[int]],
+                   user_ratings: UserRatingDict,
+                   movie_users: MovieUserDict) -> List[int]:
+    """Return the sorted ids of the users whose neighbours may have changed
+    after the ratings of the users in changes changed.
+
+    changes maps each changed user to the movies whose rating was added,
+    changed or removed, and user_ratings and movie_users are the ratings
+    after the change. A change to a user's ratings changes their norm, and
+    so their similarity to everyone who shares any movie with them, before
+    or after the change.
+
+    >>> affected_users({3: [12]}, {1: {10: 5.0}, 2: {11: 4.0},
+    ...                            3: {11: 2.0}, 4: {12: 1.0}},
+    ...                {10: [1], 11: [2, 3], 12: [4]})
+    [2, 3, 4]
+    """
+    result = set()
+    for user in changes:
+        result.add(user)
+        touched = set(changes[user])
+        if user in user_ratings:
+            touched.update(user_ratings[user])
+        for movie in touched:
+            if movie in movie_users:
+                result.update(movie_users[movie])
+    return sorted(result)
+
+
+def _neighbour_lists(users: List[int], user_ratings: UserRatingDict,
+                     movie_users: MovieUserDict, num_neighbours: int,
+                     processes: Optional[int], block_size: int,
+                     snapshot_path: Optional[str]) \
+        -> Iterator[Tuple[int, array, array]]:
+    """Yield (user, neighbour ids, similarities) for each user in users, in
+    the same order, computed in blocks of block_size users.
+    """
+    blocks = [users[i:i + block_size]
+              for i in range(0, len(users), block_size)]
+    if processes == 1:
+        user_norms = getattr(user_ratings, 'user_norms', None)
+        if user_norms is None:
+            user_norms = get_user_norms(user_ratings)
+        for block in blocks:
+            yield from _neighbour_block(block, user_ratings, movie_users,
+                                        user_norms, num_neighbours)
+        return
+    if snapshot_path is None:
+        raise ValueError('snapshot_path is needed for worker processes')
+    share_ratings(snapshot_path, user_ratings, {})
+    with multiprocessing.Pool(processes, _init_worker,
+                              (snapshot_path, num_neighbours)) as pool:
+        for lists in pool.imap(_block_in_worker, blocks):
+            yield from lists
+
+
+def _neighbour_block(users: List[int], user_ratings: UserRatingDict,
+                     movie_users: MovieUserDict,
+                     user_norms: Dict[int, float],
+                     num_neighbours: int) -> List[Tuple[int, array, array]]:
+    """Return (user, neighbour ids, similarities) for each user in users.
+    """
+    lists = []
+    for user in users:
+        similar = get_similar_users(user_ratings[user], user_ratings,
+                                    movie_users, user_norms)
+        similar.pop(user, None)
+        best = heapq.nsmallest(num_neighbours, ((-similar[other], other)
+                                                for other in similar))
+        ids = array(ID_TYPE, sorted(other for _, other in best))
+        sims = array(NORM_TYPE, [similar[other] for other in ids])
+        lists.append((user, ids, sims))
+    return lists
+
+
+def _init_worker(snapshot_path: str, num_neighbours: int) -> None:
+    """Map the snapshot at snapshot_path into this worker process.
+    """
+    global _worker_store, _worker_num_neighbours
+    loaded = load_snapshot(snapshot_path, None, use_mmap=True)
+    if loaded is None:
+        raise ValueError('cannot read snapshot ' + snapshot_path)
+    _worker_store = loaded[0]
+    _worker_num_neighbours = num_neighbours
+
+
+def _block_in_worker(users: List[int]) -> List[Tuple[int, array, array]]:
+    """Return the neighbour lists of one block of users in a worker.
+    """
+    return _neighbour_block(users, _worker_store, _worker_store.movie_users,
+                            _worker_store.user_norms, _worker_num_neighbours)
@@ -0,0 +1,364 @@
+"""Multi-process ingest and recommendation.
+
+recommend_movies_parallel never pickles the ratings to the workers. The
+parent writes (or reuses) a snapshot file, and every worker maps it read-only
+with load_snapshot, so all workers read the same page-cache copy of the
+ratings. Only the target ratings and the result lists travel between
+processes.
+
+read_rating_store_parallel splits a ratings file into newline-aligned byte
+ranges and builds the RatingStore in worker processes: parsing by byte
+range, then the rows by user partition and the columns by movie partition,
+so every pass over the ratings runs in parallel.
+"""
+
+import itertools
+import multiprocessing
+import operator
+import os
+from array import array
+from bisect import bisect_right
+from typing import Iterable, Iterator, List, Tuple
+
+from recommender_constants import MovieDict, Rating, UserRatingDict
+from recommender_functions import recommend_movies_batch, bump_data_version
+from recommender_snapshot import load_snapshot, save_snapshot
+from recommender_store import RatingStore, ID_TYPE, RATING_TYPE, \
+    OFFSET_TYPE, NORM_TYPE, append_rating
+
+# Added to user and movie ids to make them non-negative in sort keys.
+KEY_OFFSET = 1 << 31
+
+# The store, movies and (max_neighbours, min_similarity) of a worker process,
+# set by _init_worker.
+_worker_store = None
+_worker_movies = None
+_worker_pruning = (None, None)
+
+
+def share_ratings(snapshot_path: str, user_ratings: UserRatingDict,
+                  movies: MovieDict) -> None:
+    """Write user_ratings and movies to a snapshot at snapshot_path, so that
+    worker processes can map them.
+
+    user_ratings may be a UserRatingDict or a RatingStore.
+    """
+    if not isinstance(user_ratings, RatingStore):
+        user_ratings = RatingStore.from_dict(user_ratings)
+    save_snapshot(snapshot_path, user_ratings, movies, [])
+
+
+def _init_worker(snapshot_path: str, max_neighbours: int = None,
+                 min_similarity: float = None) -> None:
+    """Map the snapshot at snapshot_path into this worker process, which
+    prunes similar users with max_neighbours and min_similarity.
+    """
+    global _worker_store, _worker_movies, _worker_pruning
+    loaded = load_snapshot(snapshot_path, None, use_mmap=True)
+    if loaded is None:
+        raise ValueError('cannot read snapshot ' + snapshot_path)
+    _worker_store, _worker_movies = loaded
+    _worker_pruning = (max_neighbours, min_similarity)
+
+
+def _recommend_chunk(job: Tuple[List[Rating], int]) -> List[List[int]]:
+    """Return the recommendations for one chunk of targets in a worker.
+    """
+    targets, num_movies = job
+    max_neighbours, min_similarity = _worker_pruning
+    return recommend_movies_batch(targets, _worker_movies, _worker_store,
+                                  _worker_store.movie_users, num_movies,
+                                  max_neighbours=max_neighbours,
+                                  min_similarity=min_similarity)
+
+
+def _chunks(targets: Iterable[Rating], chunk_size: int,
+            num_movies: int) -> Iterator[Tuple[List[Rating], int]]:
+    """Yield the targets in lists of at most chunk_size, with num_movies.
+
+    >>> list(_chunks([{1: 2.0}, {2: 3.0}, {3: 4.0}], 2, 5))
+    [([{1: 2.0}, {2: 3.0}], 5), ([{3: 4.0}], 5)]
+    """
+    chunk = []
+    for target_rating in targets:
+        chunk.append(target_rating)
+        if len(chunk) == chunk_size:
+            yield chunk, num_movies
+            chunk = []
+    if chunk:
+        yield chunk, num_movies
+
+
+def recommend_movies_parallel(targets: Iterable[Rating],
+                              snapshot_path: str,
+                              num_movies: int,
+                              processes: int = None,
+                              chunk_size: int = 256,
+                              max_neighbours: int = None,
+                              min_similarity: float = None) \
+        -> Iterator[List[int]]:
+    """Yield the recommend_movies result for each target in targets, in the
+    same order, computed by a pool of processes worker processes (one per
+    core by default) over the snapshot at snapshot_path. max_neighbours and
+    min_similarity prune the similar users as in recommend_movies.
+
+    Targets are sent to the workers in chunks of chunk_size and each chunk
+    goes through recommend_movies_batch. Results are yielded as soon as the
+    chunks before them are done, so targets may be a lazy iterable.
+    """
+    with multiprocessing.Pool(processes, _init_worker,
+                              (snapshot_path, max_neighbours,
+                               min_similarity)) as pool:
+        jobs = _chunks(targets, chunk_size, num_movies)
+        for results in pool.imap(_recommend_chunk, jobs):
+            for result in results:
+                yield result
+
+
+def byte_ranges(path: str, parts: int) -> List[Tuple[int, int]]:
+    """Return about parts (start, end) byte ranges that together cover every
+    line of the file at path after the header line. Every range starts at
+    the beginning of a line and ends just after the end of one.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as source:
+        source.readline()
+        boundaries = [source.tell()]
+        first = boundaries[0]
+        for part in range(1, parts):
+            position = first + (size - first) * part // parts
+            if position <= boundaries[-1]:
+                continue
+            source.seek(position - 1)
+            source.readline()
+            boundaries.append(source.tell())
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return [(boundaries[i], boundaries[i + 1])
+            for i in range(len(boundaries) - 1)
+            if boundaries[i] < boundaries[i + 1]]
+
+
+def _parse_range(job: Tuple[str, int, int, List[int]]) \
+        -> List[Tuple[array, array, array]]:
+    """Return the user, movie and rating columns of the lines in one byte
+    range of a ratings file, in file order, split into one bucket per user
+    partition: bucket p holds the users u with bisect_right(splits, u) == p.
+    """
+    path, start, end, splits = job
+    buckets = [(array(ID_TYPE), array(ID_TYPE), array(RATING_TYPE))
+               for _ in range(len(splits) + 1)]
+    with open(path, 'rb') as source:
+        source.seek(start)
+        position = start
+        while position < end:
+            line = source.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.strip()
+            if line == b'':
+                continue
+            rating_list = line.split(b',')
+            user = int(rating_list[0])
+            users, movies, rates = buckets[bisect_right(splits, user)]
+            users.append(user)
+            movies.append(int(rating_list[1]))
+            append_rating(rates, float(rating_list[2]))
+    return buckets
+
+
+def _build_rows(job: Tuple[List[Tuple[array, array, array]], List[int]]) \
+        -> Tuple[array, array, array, array, array, List[Tuple[array,
+                                                               array]]]:
+    """Return the CSR part of the store for one user partition from its
+    buckets, given in file order.
+
+    The result is the partition's user ids, the number of ratings of each,
+    their movie ids and ratings sorted by movie within a user, their norms,
+    and the (movie ids, user ids) of those ratings split into one bucket per
+    movie partition, as _parse_range splits users.
+    """
+    parts, movie_splits = job
+    users = array(ID_TYPE)
+    movies = array(ID_TYPE)
+    rates = array(RATING_TYPE)
+    for part_users, part_movies, part_rates in parts:
+        users.extend(part_users)
+        movies.extend(part_movies)
+        rates.extend(part_rates)
+    # One int per row as the sort key; sorted is stable, so of two ratings
+    # of the same movie by the same user, the later one in the file is last.
+    keys = array('Q', [((user + KEY_OFFSET) << 32) + movie + KEY_OFFSET
+                       for user, movie in zip(users, movies)])
+    n = len(keys)
+    if all(map(operator.le, keys, keys[1:])):
+        order = range(n)
+    else:
+        order = sorted(range(n), key=keys.__getitem__)
+
+    user_ids = array(ID_TYPE)
+    counts = array(OFFSET_TYPE)
+    movie_ids = array(ID_TYPE)
+    row_ratings = array(RATING_TYPE)
+    norms = array(NORM_TYPE)
+    columns = [(array(ID_TYPE), array(ID_TYPE))
+               for _ in range(len(movie_splits) + 1)]
+    norm = 0.0
+    for k in range(n):
+        i = order[k]
+        if k + 1 < n and keys[order[k + 1]] == keys[i]:
+            continue
+        user = users[i]
+        movie = movies[i]
+        if len(user_ids) == 0 or user_ids[-1] != user:
+            if len(user_ids) > 0:
+                norms.append(norm)
+            user_ids.append(user)
+            counts.append(0)
+            norm = 0.0
+        counts[-1] += 1
+        movie_ids.append(movie)
+        row_ratings.append(rates[i])
+        norm = norm + rates[i] ** 2
+        col_movies, col_users = columns[bisect_right(movie_splits, movie)]
+        col_movies.append(movie)
+        col_users.append(user)
+    if len(user_ids) > 0:
+        norms.append(norm)
+    return user_ids, counts, movie_ids, row_ratings, norms, columns
+
+
+def _build_columns(parts: List[Tuple[array, array]]) \
+        -> Tuple[array, array, array]:
+    """Return the CSC part of the store for one movie partition from its
+    (movie ids, user ids) buckets, given in user partition order: the
+    partition's movie ids, the number of users of each, and their user ids
+    in increasing order.
+    """
+    movies = array(ID_TYPE)
+    users = array(ID_TYPE)
+    for part_movies, part_users in parts:
+        movies.extend(part_movies)
+        users.extend(part_users)
+    # Users are already in increasing order, and sorted is stable.
+    order = sorted(range(len(movies)), key=movies.__getitem__)
+    col_movie_ids = array(ID_TYPE)
+    counts = array(OFFSET_TYPE)
+    col_user_ids = array(ID_TYPE)
+    for i in order:
+        if len(col_movie_ids) == 0 or col_movie_ids[-1] != movies[i]:
+            col_movie_ids.append(movies[i])
+            counts.append(0)
+        counts[-1] += 1
+        col_user_ids.append(users[i])
+    return col_movie_ids, counts, col_user_ids
+
+
+def sample_splits(path: str, ranges: List[Tuple[int, int]], parts: int,
+                  samples: int = 64) -> Tuple[List[int], List[int]]:
+    """Return about parts - 1 sorted, distinct user ids and movie ids that
+    split the ratings in the file at path into parts partitions of about
+    the same size, estimated from samples lines in each byte range.
+    """
+    users = []
+    movies = []
+    with open(path, 'rb') as source:
+        for start, end in ranges:
+            for k in range(samples):
+                source.seek(start + (end - start) * k // samples)
+                if k > 0:
+                    source.readline()
+                if source.tell() >= end:
+                    break
+                rating_list = source.readline().split(b',')
+                if len(rating_list) >= 3:
+                    users.append(int(rating_list[0]))
+                    movies.append(int(rating_list[1]))
+    return _quantiles(users, parts), _quantiles(movies, parts)
+
+
+def _quantiles(values: List[int], parts: int) -> List[int]:
+    """Return the distinct values that split the sorted values into parts
+    runs of about the same length.
+
+    >>> _quantiles([5, 1, 4, 2, 3, 6], 3)
+    [3, 5]
+    """
+    values = sorted(values)
+    splits = []
+    for part in range(1, parts):
+        value = values[len(values) * part // parts] if values else 0
+        if not splits or value > splits[-1]:
+            splits.append(value)
+    return splits
+
+
+def read_rating_store_parallel(path: str, processes: int = None,
+                               parts: int = None) -> RatingStore:
+    """Return a RatingStore of the ratings file at path, built by a pool of
+    processes worker processes (one per core by default).
+
+    The file is split into parts byte ranges (four per process by default),
+    and the store is built in three parallel steps:
+
+    1. each byte range is parsed into typed arrays, split by user into
+       parts partitions (user id ranges sampled from the file);
+    2. each user partition is sorted into its rows of the store, with the
+       norms, and split by movie into parts partitions;
+    3. each movie partition is sorted into its columns of the store.
+
+    The parent only joins the arrays of the partitions, in order. If a user
+    rated the same movie more than once, the last rating in the file wins,
+    as in read_ratings. The result is the same as read_rating_store.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if parts is None:
+        parts = processes * 4
+    bump_data_version()
+    ranges = byte_ranges(path, parts)
+    user_splits, movie_splits = sample_splits(path, ranges, parts)
+    with multiprocessing.Pool(processes) as pool:
+        parsed = pool.map(_parse_range, [(path, start, end, user_splits)
+                                         for start, end in ranges])
+        rows = pool.map(_build_rows,
+                        [([buckets[p] for buckets in parsed], movie_splits)
+                         for p in range(len(user_splits) + 1)])
+        del parsed
+        columns = pool.map(_build_columns,
+                           [[row[5][q] for row in rows]
+                            for q in range(len(movie_splits) + 1)])
+
+    user_ids = array(ID_TYPE)
+    user_counts = array(OFFSET_TYPE)
+    movie_ids = array(ID_TYPE)
+    row_ratings = array(RATING_TYPE)
+    norms = array(NORM_TYPE)
+    for part_users, counts, part_movies, part_ratings, part_norms, _ in rows:
+        user_ids.extend(part_users)
+        user_counts.extend(counts)
+        movie_ids.extend(part_movies)
+        row_ratings.extend(part_ratings)
+        norms.extend(part_norms)
+    col_movie_ids = array(ID_TYPE)
+    col_counts = array(OFFSET_TYPE)
+    col_user_ids = array(ID_TYPE)
+    for part_movies, counts, part_users in columns:
+        col_movie_ids.extend(part_movies)
+        col_counts.extend(counts)
+        col_user_ids.extend(part_users)
+    return RatingStore(user_ids, _offsets(user_counts), movie_ids,
+                       row_ratings, col_movie_ids, _offsets(col_counts),
+                       col_user_ids, norms)
+
+
+def _offsets(counts: array) -> array:
+    """Return the offsets of runs of the given lengths.
+
+    >>> list(_offsets(array(OFFSET_TYPE, [2, 0, 3])))
+    [0, 2, 2, 5]
+    """
+    offsets = array(OFFSET_TYPE, [0])
+    offsets.extend(itertools.accumulate(counts))
+    return offsets
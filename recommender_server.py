@@ -0,0 +1,343 @@
+"""An asyncio recommendation service with micro-batching.
+
+Clients connect over a Unix socket (or TCP) and send one JSON request per
+line:
+
+    {"rating": {"68735": 4.5, "302156": 3.0}, "num_movies": 10}
+
+and get back one JSON line per request, in order: the list of recommended
+movie ids, or {"error": message}.
+
+Incoming requests go into a bounded queue. A MicroBatcher takes up to
+max_batch of them, waiting at most max_delay seconds after the first one for
+more, and runs the whole batch through recommend_movies_batch on a worker
+thread, so the event loop keeps accepting requests while a batch is scored.
+At most max_in_flight requests are admitted at once; beyond that, clients
+wait, and a full queue pushes back on the connections feeding it.
+
+Usage:
+
+    python recommender_server.py SNAPSHOT --socket /tmp/recommender.sock
+"""
+
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from recommender_constants import MovieDict, Rating, UserRatingDict, \
+    MovieUserDict
+from recommender_functions import recommend_movies_batch
+from recommender_snapshot import load_snapshot
+
+
+class MicroBatcher:
+    """Groups concurrent recommendation requests into batches.
+
+    === Public Attributes ===
+    max_batch: the most requests scored together
+    max_delay: the most seconds to wait for a batch to fill
+    batches: the number of batches run so far
+    requests: the number of requests answered so far
+
+    === Private Attributes ===
+    _movies, _user_ratings, _movie_users: the data recommendations come from
+    _max_neighbours, _min_similarity: how similar users are pruned, as in
+        recommend_movies
+    _queue: the requests waiting for a batch
+    _in_flight: limits the requests admitted at once
+    _executor: the single thread batches are scored on
+    """
+    max_batch: int
+    max_delay: float
+    batches: int
+    requests: int
+
+    def __init__(self, movies: MovieDict, user_ratings: UserRatingDict,
+                 movie_users: MovieUserDict, max_batch: int = 64,
+                 max_delay: float = 0.005, max_in_flight: int = 1024,
+                 max_queue: int = 256, max_neighbours: Optional[int] = None,
+                 min_similarity: Optional[float] = None) -> None:
+        """Initialize a batcher over the given data, pruning similar users
+        with max_neighbours and min_similarity.
+        """
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self.requests = 0
+        self._movies = movies
+        self._user_ratings = user_ratings
+        self._movie_users = movie_users
+        self._max_neighbours = max_neighbours
+        self._min_similarity = min_similarity
+        self._queue = asyncio.Queue(max_queue)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(1)
+
+    async def recommend(self, target_rating: Rating,
+                        num_movies: int) -> List[int]:
+        """Return recommend_movies(target_rating, ..., num_movies), computed
+        as part of a batch.
+        """
+        async with self._in_flight:
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((target_rating, num_movies, future))
+            return await future
+
+    async def run(self) -> None:
+        """Score batches of queued requests until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._score, batch)
+            except Exception as error:
+                results = [error] * len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.batches += 1
+            self.requests += len(batch)
+
+    def _score(self, batch: List[Tuple[Rating, int, asyncio.Future]]) \
+            -> List[Union[List[int], Exception]]:
+        """Return the recommendations for each request in batch, grouping
+        requests that ask for the same number of movies.
+
+        If scoring a group fails, its requests are scored one at a time, so
+        a request that fails gets its own exception in place of a result and
+        does not fail the others.
+        """
+        groups = {}
+        for i, (target_rating, num_movies, _) in enumerate(batch):
+            groups.setdefault(num_movies, []).append(i)
+        results = [None] * len(batch)
+        for num_movies, positions in groups.items():
+            try:
+                answers = recommend_movies_batch(
+                    [batch[i][0] for i in positions], self._movies,
+                    self._user_ratings, self._movie_users, num_movies,
+                    max_neighbours=self._max_neighbours,
+                    min_similarity=self._min_similarity)
+            except Exception:
+                answers = [self._score_one(batch[i][0], num_movies)
+                           for i in positions]
+            for i, answer in zip(positions, answers):
+                results[i] = answer
+        return results
+
+    def _score_one(self, target_rating: Rating,
+                   num_movies: int) -> Union[List[int], Exception]:
+        """Return the recommendations for one request, or the exception
+        scoring it raised.
+        """
+        try:
+            return recommend_movies_batch(
+                [target_rating], self._movies, self._user_ratings,
+                self._movie_users, num_movies,
+                max_neighbours=self._max_neighbours,
+                min_similarity=self._min_similarity)[0]
+        except Exception as error:
+            return error
+
+
+def parse_request(line: bytes) -> Tuple[Rating, int]:
+    """Return the target rating and num_movies of a request line.
+
+    Raise ValueError if line is not a valid request, or if every rating in
+    it is zero, which leaves nothing to compare other users to.
+
+    >>> parse_request(b'{"rating": {"10": 4.5}, "num_movies": 3}')
+    ({10: 4.5}, 3)
+    >>> parse_request(b'{"rating": {"10": 0.0}}')
+    Traceback (most recent call last):
+    ...
+    ValueError: bad request: rating has no non-zero values
+    """
+    try:
+        request = json.loads(line)
+        rating = {int(movie): float(rate)
+                  for movie, rate in request['rating'].items()}
+        num_movies = int(request.get('num_movies', 10))
+    except (KeyError, TypeError, AttributeError, json.JSONDecodeError) as error:
+        raise ValueError('bad request: {}'.format(error))
+    if not any(rating.values()):
+        raise ValueError('bad request: rating has no non-zero values')
+    return rating, num_movies
+
+
+async def handle_client(batcher: MicroBatcher, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter,
+                        max_pending: int = 256) -> None:
+    """Answer the requests of one connection, one line each, in order.
+
+    Requests on the same connection are scored concurrently, so a client
+    that pipelines many lines shares batches with itself and others. At most
+    max_pending of its requests are outstanding; past that, the connection is
+    not read until earlier answers are written.
+
+    If the client goes away, reading stops, and the requests it still had
+    outstanding are cancelled.
+    """
+    pending = asyncio.Queue(max_pending)
+
+    async def reply() -> None:
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            try:
+                answer = await task
+            except Exception as error:
+                answer = {'error': str(error)}
+            try:
+                writer.write(json.dumps(answer).encode('utf-8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def put(item: Optional[asyncio.Future]) -> bool:
+        """Queue item for reply() and return True, or return False if
+        reply() has stopped.
+        """
+        putter = asyncio.ensure_future(pending.put(item))
+        await asyncio.wait([putter, replier],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if putter.done():
+            return True
+        putter.cancel()
+        return False
+
+    replier = asyncio.ensure_future(reply())
+    task = None
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                break
+            if not line:
+                break
+            try:
+                target_rating, num_movies = parse_request(line)
+            except ValueError as error:
+                task = _done({'error': str(error)})
+            else:
+                task = batcher.recommend(target_rating, num_movies)
+            task = asyncio.ensure_future(task)
+            if not await put(task):
+                break
+            task = None
+        if await put(None):
+            await replier
+    finally:
+        replier.cancel()
+        if task is not None:
+            task.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+        writer.close()
+
+
+async def _done(value: object) -> object:
+    """Return value, as a coroutine.
+    """
+    return value
+
+
+async def serve(batcher: MicroBatcher, socket_path: Optional[str] = None,
+                host: str = '127.0.0.1', port: int = 8148) -> None:
+    """Serve requests with batcher on the Unix socket at socket_path, or on
+    host and port over TCP if socket_path is None, until cancelled.
+    """
+    runner = asyncio.ensure_future(batcher.run())
+
+    async def on_connect(reader, writer):
+        await handle_client(batcher, reader, writer)
+
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(on_connect, socket_path)
+    else:
+        server = await asyncio.start_server(on_connect, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        runner.cancel()
+
+
+async def request_recommendations(requests: List[Tuple[Rating, int]],
+                                  socket_path: Optional[str] = None,
+                                  host: str = '127.0.0.1',
+                                  port: int = 8148) -> List[object]:
+    """Send every (target rating, num_movies) in requests over one
+    connection and return the answers in order.
+    """
+    if socket_path is not None:
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    for target_rating, num_movies in requests:
+        writer.write(json.dumps({'rating': target_rating,
+                                 'num_movies': num_movies}).encode('utf-8')
+                     + b'\n')
+    await writer.drain()
+    answers = []
+    for _ in requests:
+        answers.append(json.loads(await reader.readline()))
+    writer.close()
+    return answers
+
+
+def main(argv: List[str] = None) -> None:
+    """Serve the snapshot named on the command line.
+    """
+    parser = argparse.ArgumentParser(description='Serve recommendations.')
+    parser.add_argument('snapshot')
+    parser.add_argument('--socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8148)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-delay', type=float, default=0.005)
+    parser.add_argument('--max-in-flight', type=int, default=1024)
+    parser.add_argument('--max-neighbours', type=int)
+    parser.add_argument('--min-similarity', type=float)
+    args = parser.parse_args(argv)
+
+    loaded = load_snapshot(args.snapshot, None, use_mmap=True)
+    if loaded is None:
+        parser.error('cannot read snapshot ' + args.snapshot)
+    store, movies = loaded
+
+    async def run() -> None:
+        batcher = MicroBatcher(movies, store, store.movie_users,
+                               args.max_batch, args.max_delay,
+                               args.max_in_flight,
+                               max_neighbours=args.max_neighbours,
+                               min_similarity=args.min_similarity)
+        await serve(batcher, args.socket, args.host, args.port)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Binary snapshots of parsed ratings and movies.
+
+Parsing the ratings and movies CSV files and cleaning them with
+remove_unknown_movies takes minutes on a full dataset. A snapshot stores the
+result -- the cleaned RatingStore (which includes the movie to users index and
+the user norms) and the movie table -- as typed columns in a single file, so
+that a later process can load it back in one read.
+
+File layout:
+
+    MAGIC                8 bytes
+    header length        8 bytes, little endian
+    header               JSON: format version, byte order, the fingerprint of
+                         every source file, and the offset, length and type
+                         code of every column
+    columns              raw array bytes, each starting on an 8 byte boundary
+
+A snapshot records the size and modification time (and optionally the SHA-256)
+of the CSV files it was built from, and load_snapshot refuses a snapshot
+whose sources have changed since.
+
+load_snapshot(..., use_mmap=True) maps the file read-only instead of copying
+it, and the RatingStore it returns reads straight from the mapped pages. Every
+process that maps the same snapshot shares one copy of it in the page cache,
+so adding worker processes on a host does not add copies of the ratings.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from recommender_constants import MovieDict
+from recommender_store import RatingStore
+from recommender_functions import read_movies, read_rating_store, \
+    bump_data_version
+
+MAGIC = b'RECSNAP1'
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+# Separates a movie's title and genres in the movie text column.
+FIELD_SEPARATOR = '\x1f'
+
+
+def fingerprint(path: str, use_hash: bool = False) -> Dict[str, object]:
+    """Return the size and modification time of the file at path, and its
+    SHA-256 digest if use_hash is True.
+    """
+    info = os.stat(path)
+    result = {'path': os.path.abspath(path), 'size': info.st_size,
+              'mtime_ns': info.st_mtime_ns}
+    if use_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source:
+            chunk = source.read(1 << 20)
+            while chunk:
+                digest.update(chunk)
+                chunk = source.read(1 << 20)
+        result['sha256'] = digest.hexdigest()
+    return result
+
+
+def _movie_columns(movies: MovieDict) -> Dict[str, array]:
+    """Return the movie table as typed columns.
+
+    >>> columns = _movie_columns({7: ('Up', ['Comedy']), 3: ('It', [])})
+    >>> list(columns['movie_table_ids'])
+    [3, 7]
+    >>> list(columns['movie_text_offsets'])
+    [0, 2, 11]
+    """
+    ids = array('i', sorted(movies))
+    offsets = array('q', [0])
+    text = bytearray()
+    for movie in ids:
+        title, genres = movies[movie]
+        text += FIELD_SEPARATOR.join([title] + genres).encode('utf-8')
+        offsets.append(len(text))
+    return {'movie_table_ids': ids, 'movie_text_offsets': offsets,
+            'movie_text': array('B', bytes(text))}
+
+
+def _movies_from_columns(ids, offsets, text) -> MovieDict:
+    """Return the movie table stored in the columns made by _movie_columns.
+
+    >>> columns = _movie_columns({7: ('Up', ['Comedy']), 3: ('It', [])})
+    >>> _movies_from_columns(columns['movie_table_ids'],
+    ...                      columns['movie_text_offsets'],
+    ...                      columns['movie_text'])
+    {3: ('It', []), 7: ('Up', ['Comedy'])}
+    """
+    raw = bytes(text)
+    movies = {}
+    for i in range(len(ids)):
+        fields = raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+        fields = fields.split(FIELD_SEPARATOR)
+        movies[ids[i]] = (fields[0], fields[1:])
+    return movies
+
+
+def save_snapshot(path: str, store: RatingStore, movies: MovieDict,
+                  sources: List[str], use_hash: bool = False) -> None:
+    """Write store and movies to a snapshot file at path, recording the
+    fingerprints of the source files they were parsed from.
+    """
+    columns = {}
+    for name in RatingStore.COLUMNS:
+        columns[name] = getattr(store, name)
+    columns.update(_movie_columns(movies))
+    write_columns(path, columns,
+                  [fingerprint(source, use_hash) for source in sources])
+
+
+def write_columns(path: str, columns: Dict[str, object],
+                  sources: List[Dict[str, object]]) -> None:
+    """Write the typed arrays in columns to a file at path in the snapshot
+    layout, with the source fingerprints in sources.
+
+    The file is written next to path and then renamed over it, so a reader
+    never sees a half-written file.
+    """
+    sections = []
+    offset = 0
+    for name in columns:
+        column = memoryview(columns[name])
+        sections.append({'name': name, 'typecode': column.format,
+                         'offset': offset, 'length': len(column)})
+        offset += _aligned(column.nbytes)
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'sources': sources,
+        'sections': sections}).encode('utf-8')
+    header += b' ' * (_aligned(len(header)) - len(header))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(len(header).to_bytes(8, 'little'))
+        snapshot.write(header)
+        for name in columns:
+            column = memoryview(columns[name])
+            snapshot.write(column)
+            snapshot.write(bytes(_aligned(column.nbytes) - column.nbytes))
+    os.replace(temp_path, path)
+
+
+def _aligned(size: int) -> int:
+    """Return size rounded up to a multiple of ALIGNMENT.
+
+    >>> _aligned(13)
+    16
+    >>> _aligned(16)
+    16
+    """
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def read_header(data) -> Tuple[dict, int]:
+    """Return the header of the snapshot bytes in data and the offset at
+    which its columns start.
+
+    Raise ValueError if data is not a snapshot this version can read, or if
+    it is too short to hold every column its header lists. A header that is
+    missing entries may also raise KeyError or TypeError.
+    """
+    start = len(MAGIC) + 8
+    if len(data) < start or bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError('not a recommender snapshot')
+    length = int.from_bytes(data[len(MAGIC):start], 'little')
+    if start + length > len(data):
+        raise ValueError('truncated snapshot header')
+    header = json.loads(bytes(data[start:start + length]).decode('utf-8'))
+    if not isinstance(header, dict) \
+            or header.get('version') != FORMAT_VERSION \
+            or header.get('byteorder') != sys.byteorder:
+        raise ValueError('unsupported snapshot format')
+    base = start + length
+    for section in header['sections']:
+        size = section['length'] * array(section['typecode']).itemsize
+        if section['offset'] < 0 or size < 0 \
+                or base + section['offset'] + size > len(data):
+            raise ValueError('truncated snapshot column ' + section['name'])
+    return header, base
+
+
+def is_current(header: dict, sources: List[str]) -> bool:
+    """Return whether the source fingerprints in a snapshot header still
+    match the files in sources.
+    """
+    recorded = header['sources']
+    if len(recorded) != len(sources):
+        return False
+    for old, path in zip(recorded, sources):
+        if not os.path.exists(path):
+            return False
+        if fingerprint(path, 'sha256' in old) != old:
+            return False
+    return True
+
+
+def _columns_from(header: dict, data, base: int) -> Dict[str, object]:
+    """Return a {name: array} of the columns in data, copied out of it.
+    """
+    columns = {}
+    for section in header['sections']:
+        column = array(section['typecode'])
+        start = base + section['offset']
+        column.frombytes(data[start:start + section['length']
+                              * column.itemsize])
+        columns[section['name']] = column
+    return columns
+
+
+def _views_from(header: dict, data: memoryview,
+                base: int) -> Dict[str, memoryview]:
+    """Return a {name: memoryview} of the columns in data, without copying.
+    """
+    columns = {}
+    for section in header['sections']:
+        start = base + section['offset']
+        size = section['length'] * array(section['typecode']).itemsize
+        columns[section['name']] = \
+            data[start:start + size].cast(section['typecode'])
+    return columns
+
+
+def read_columns(path: str, sources: Optional[List[str]],
+                 use_mmap: bool = False) -> Optional[Dict[str, object]]:
+    """Return a {name: typed array} of the columns in the file at path,
+    written by write_columns.
+
+    Return None if there is no file at path, it is empty, truncated or
+    cannot be read, or any of the source files has changed since it was
+    written. If sources is None, the source files are not checked.
+
+    If use_mmap is True, the file is mapped read-only and the columns are
+    memoryviews into the mapping rather than copies; the mapping stays open
+    for as long as any column is in use.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as snapshot:
+        if use_mmap:
+            data = memoryview(mmap.mmap(snapshot.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+        else:
+            data = snapshot.read()
+    try:
+        header, base = read_header(data)
+        if sources is not None and not is_current(header, sources):
+            return None
+    except (ValueError, KeyError, TypeError):
+        return None
+    if use_mmap:
+        return _views_from(header, data, base)
+    return _columns_from(header, data, base)
+
+
+def load_snapshot(path: str, sources: Optional[List[str]],
+                  use_mmap: bool = False) -> Optional[Tuple[RatingStore,
+                                                            MovieDict]]:
+    """Return the RatingStore and movie table saved in the snapshot at path.
+
+    Return None if there is no snapshot at path, it cannot be read, or any of
+    the source files has changed since it was saved. If sources is None, the
+    source files are not checked.
+
+    If use_mmap is True, the file is mapped read-only and the store's arrays
+    are memoryviews into the mapping rather than copies; the mapping stays
+    open for as long as the store is in use.
+    """
+    columns = read_columns(path, sources, use_mmap)
+    if columns is None:
+        return None
+    return _unpack(columns)
+
+
+def _unpack(columns: Dict[str, object]) -> Tuple[RatingStore, MovieDict]:
+    """Return the RatingStore and movie table held in columns.
+    """
+    bump_data_version()
+    store = RatingStore(*[columns[name] for name in RatingStore.COLUMNS])
+    movies = _movies_from_columns(columns['movie_table_ids'],
+                                  columns['movie_text_offsets'],
+                                  columns['movie_text'])
+    return store, movies
+
+
+def load_or_build(snapshot_path: str, movie_path: str, rating_path: str,
+                  use_hash: bool = False) -> Tuple[RatingStore, MovieDict]:
+    """Return the cleaned RatingStore and movie table for the given movies
+    and ratings CSV files.
+
+    They are loaded from the snapshot at snapshot_path if it is current.
+    Otherwise the CSV files are parsed, unknown movies are removed, and a new
+    snapshot is saved for next time.
+    """
+    sources = [movie_path, rating_path]
+    loaded = load_snapshot(snapshot_path, sources)
+    if loaded is not None:
+        return loaded
+    with open(movie_path) as movie_file:
+        movies = read_movies(movie_file)
+    with open(rating_path) as rating_file:
+        store = read_rating_store(rating_file)
+    store = store.filter_movies(movies)
+    save_snapshot(snapshot_path, store, movies, sources, use_hash)
+    return store, movies
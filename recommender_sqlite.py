@@ -0,0 +1,401 @@
+"""An out-of-core ratings backend stored in an indexed SQLite database.
+
+read_ratings keeps every rating in memory, which fails for rating histories
+larger than RAM. build_database streams the movies and ratings files into a
+SQLite file instead:
+
+    movies(movie_id, title, genres)
+    ratings(user_id, movie_id, rating)    clustered by (user_id, movie_id)
+    ratings_by_movie                      index on (movie_id, user_id)
+    norms(user_id, norm)                  the sum of each user's squared
+                                          ratings
+
+Ratings of movies that are not in the movies file are dropped, as by
+remove_unknown_movies.
+
+SqliteRatings.open gives a read-only {user id: {movie id: rating}} mapping
+over the database, with movie_users and user_norms views, so that
+get_users_who_watched, get_similar_users, get_movie_score and recommend_movies
+accept it in place of a UserRatingDict and a MovieUserDict. Every lookup is an
+indexed query, and recently used rows are kept in a buffer holding at most
+max_buffered ids and ratings, so memory stays bounded however large the
+database is. Each user's ratings come back in movie id order, as from a
+RatingStore, so results are identical to the in-memory path.
+"""
+
+import itertools
+import os
+import sqlite3
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Optional, Sized, TextIO
+
+from recommender_constants import MovieDict
+from recommender_functions import read_movies, iter_ratings, \
+    bump_data_version
+from recommender_store import ID_TYPE
+
+# The number of rows written to the database in each executemany call.
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE movies (movie_id INTEGER PRIMARY KEY, title TEXT, genres TEXT);
+CREATE TABLE ratings (user_id INTEGER NOT NULL, movie_id INTEGER NOT NULL,
+                      rating REAL NOT NULL, PRIMARY KEY (user_id, movie_id))
+    WITHOUT ROWID;
+CREATE TABLE norms (user_id INTEGER PRIMARY KEY, norm REAL NOT NULL);
+"""
+
+
+def build_database(path: str, movie_file: TextIO, rating_file: TextIO,
+                   report: Callable[[int, float], None] = None,
+                   report_every: int = 1000000) -> None:
+    """Write the movies in movie_file and the ratings in rating_file to a new
+    SQLite database at path, replacing any file already there.
+
+    The ratings are streamed into the database in batches, so memory use does
+    not grow with the size of rating_file; report and report_every are
+    passed on to iter_ratings. If a user rated the same movie more than once,
+    the last rating wins, as in read_ratings.
+
+    The database is built next to path and then renamed over it, so a reader
+    never sees a half-built database, and a build that fails leaves nothing
+    behind.
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.executescript(SCHEMA)
+        movies = read_movies(movie_file)
+        connection.executemany(
+            'INSERT INTO movies VALUES (?, ?, ?)',
+            ((movie, movies[movie][0], _join_genres(movies[movie][1]))
+             for movie in movies))
+        rows = iter_ratings(rating_file, report, report_every)
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        while batch:
+            connection.executemany(
+                'INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)', batch)
+            batch = list(itertools.islice(rows, BATCH_SIZE))
+        connection.execute('DELETE FROM ratings WHERE movie_id NOT IN '
+                           '(SELECT movie_id FROM movies)')
+        connection.execute('CREATE INDEX ratings_by_movie '
+                           'ON ratings (movie_id, user_id)')
+        _write_norms(connection)
+        connection.commit()
+    except BaseException:
+        connection.close()
+        os.remove(temp_path)
+        raise
+    connection.close()
+    os.replace(temp_path, path)
+
+
+def _join_genres(genres: List[str]) -> Optional[str]:
+    """Return genres as stored in the movies table: joined by commas, or
+    None if there are none, so that [] and [''] stay apart.
+
+    >>> _join_genres([]), _join_genres(['']), _join_genres(['Drama', 'War'])
+    (None, '', 'Drama,War')
+    """
+    if len(genres) == 0:
+        return None
+    return ','.join(genres)
+
+
+def _write_norms(connection: sqlite3.Connection) -> None:
+    """Fill the norms table from the ratings table.
+
+    Each norm is added up in Python in movie id order, the same order as
+    RatingStore, rather than by SQL SUM, whose rounding may differ.
+    """
+    rows = connection.execute('SELECT user_id, rating FROM ratings '
+                              'ORDER BY user_id, movie_id')
+    batch = []
+    user = None
+    norm = 0.0
+    for row_user, rating in rows:
+        if row_user != user:
+            if user is not None:
+                batch.append((user, norm))
+            user = row_user
+            norm = 0.0
+        norm = norm + rating ** 2
+        if len(batch) >= BATCH_SIZE:
+            connection.executemany('INSERT INTO norms VALUES (?, ?)', batch)
+            batch = []
+    if user is not None:
+        batch.append((user, norm))
+    connection.executemany('INSERT INTO norms VALUES (?, ?)', batch)
+
+
+class _Buffer:
+    """A least recently used buffer of query results, bounded by their total
+    length.
+
+    === Public Attributes ===
+    max_items: the most ids and ratings the buffered results may hold
+    hits: the number of lookups answered from the buffer
+    misses: the number of lookups that ran a query
+
+    === Private Attributes ===
+    _entries: key to result, least recently used first
+    _items: the total length of the results in _entries
+    """
+    max_items: int
+    hits: int
+    misses: int
+    _entries: OrderedDict
+    _items: int
+
+    def __init__(self, max_items: int) -> None:
+        """Initialize an empty buffer of at most max_items ids and ratings.
+        """
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._items = 0
+
+    def get(self, key: tuple, load: Callable[[], Sized]) -> Sized:
+        """Return the result under key, calling load to get it if it is not
+        buffered.
+        """
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = load()
+        size = max(1, len(result))
+        if size <= self.max_items:
+            self._entries[key] = result
+            self._items += size
+            while self._items > self.max_items:
+                _, oldest = self._entries.popitem(last=False)
+                self._items -= max(1, len(oldest))
+        return result
+
+    def clear(self) -> None:
+        """Remove every buffered result.
+        """
+        self._entries.clear()
+        self._items = 0
+
+
+class SqliteRatings(Mapping):
+    """A read-only {user id: {movie id: rating}} mapping over a database
+    written by build_database.
+
+    === Public Attributes ===
+    connection: the open database
+
+    === Private Attributes ===
+    _buffer: the recently used ratings, posting lists and norms
+    _movie_users: the {movie id: user ids} view of this mapping
+    _user_norms: the {user id: sum of squared ratings} view of this mapping
+
+    >>> import os, tempfile
+    >>> from io import StringIO
+    >>> path = os.path.join(tempfile.mkdtemp(), 'ratings.db')
+    >>> build_database(path, StringIO('movieId,title,date,vote,genres\\n'
+    ...                               '10,Ten,,,\\n17,Seventeen,,,\\n'),
+    ...                StringIO('userId,movieId,rating\\n2,17,5.0\\n'
+    ...                         '2,10,4.0\\n1,10,3.0\\n1,99,2.0\\n'))
+    >>> ratings = SqliteRatings.open(path)
+    >>> ratings[2]
+    {10: 4.0, 17: 5.0}
+    >>> list(ratings.movie_users[10])
+    [1, 2]
+    >>> ratings.user_norms[1]
+    9.0
+    >>> ratings.close()
+    """
+    connection: sqlite3.Connection
+    _buffer: _Buffer
+
+    def __init__(self, connection: sqlite3.Connection,
+                 max_buffered: int = 1000000) -> None:
+        """Initialize a mapping over the database open on connection that
+        buffers at most max_buffered ids and ratings.
+        """
+        self.connection = connection
+        self._buffer = _Buffer(max_buffered)
+        self._movie_users = SqliteMovieUsers(self)
+        self._user_norms = SqliteNorms(self)
+
+    @classmethod
+    def open(cls, path: str, max_buffered: int = 1000000) -> 'SqliteRatings':
+        """Return a mapping over the database at path, opened read-only.
+
+        The connection may be used from another thread than the one that
+        opened it, but only from one thread at a time.
+        """
+        connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True,
+                                     check_same_thread=False)
+        bump_data_version()
+        return cls(connection, max_buffered)
+
+    def close(self) -> None:
+        """Close the database and empty the buffer.
+        """
+        self._buffer.clear()
+        self.connection.close()
+
+    @property
+    def movie_users(self) -> 'SqliteMovieUsers':
+        """Return a {movie id: user ids} view of this mapping.
+        """
+        return self._movie_users
+
+    @property
+    def user_norms(self) -> 'SqliteNorms':
+        """Return a {user id: sum of squared ratings} view of this mapping.
+        """
+        return self._user_norms
+
+    def _buffered(self, key: tuple, query: str, argument: int,
+                 make: Callable[[list], Sized]) -> Sized:
+        """Return make applied to the rows of query run with argument, from
+        the buffer under key if possible.
+        """
+        return self._buffer.get(key, lambda: make(
+            self.connection.execute(query, (argument,)).fetchall()))
+
+    def _row(self, user: object) -> Dict[int, float]:
+        """Return user's {movie id: rating} in movie id order, which is empty
+        if user has no ratings.
+        """
+        return self._buffered(('user', user),
+                             'SELECT movie_id, rating FROM ratings '
+                             'WHERE user_id = ? ORDER BY movie_id',
+                             user, dict)
+
+    def __getitem__(self, user: int) -> Dict[int, float]:
+        """Return user's {movie id: rating}. It must not be modified.
+        """
+        rating = self._row(user)
+        if len(rating) == 0:
+            raise KeyError(user)
+        return rating
+
+    def __contains__(self, user: object) -> bool:
+        """Return whether user has any ratings.
+        """
+        return len(self._row(user)) > 0
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the user ids in increasing order.
+        """
+        for (user,) in self.connection.execute(
+                'SELECT user_id FROM norms ORDER BY user_id'):
+            yield user
+
+    def __len__(self) -> int:
+        """Return the number of users with ratings.
+        """
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM norms').fetchone()[0]
+
+    def num_ratings(self) -> int:
+        """Return the total number of ratings.
+        """
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM ratings').fetchone()[0]
+
+    def movies(self) -> MovieDict:
+        """Return the movies in the database, as read_movies would.
+        """
+        result = {}
+        for movie, title, genres in self.connection.execute(
+                'SELECT movie_id, title, genres FROM movies'):
+            result[movie] = (title, [] if genres is None
+                             else genres.split(','))
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """Return the buffer's hits and misses.
+        """
+        return {'hits': self._buffer.hits, 'misses': self._buffer.misses}
+
+
+class SqliteMovieUsers(Mapping):
+    """A read-only {movie id: user ids} view of a SqliteRatings, answered
+    from the ratings_by_movie index. User ids are in increasing order.
+    """
+    _ratings: SqliteRatings
+
+    def __init__(self, ratings: SqliteRatings) -> None:
+        """Initialize a view of ratings.
+        """
+        self._ratings = ratings
+
+    def _users(self, movie: object) -> array:
+        """Return the ids of the users who rated movie, in increasing order.
+        """
+        return self._ratings._buffered(
+            ('movie', movie),
+            'SELECT user_id FROM ratings WHERE movie_id = ? ORDER BY user_id',
+            movie, lambda rows: array(ID_TYPE, [user for (user,) in rows]))
+
+    def __getitem__(self, movie: int) -> array:
+        """Return the ids of the users who rated movie. It must not be
+        modified.
+        """
+        users = self._users(movie)
+        if len(users) == 0:
+            raise KeyError(movie)
+        return users
+
+    def __contains__(self, movie: object) -> bool:
+        """Return whether anybody rated movie.
+        """
+        return len(self._users(movie)) > 0
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the rated movie ids in increasing order.
+        """
+        for (movie,) in self._ratings.connection.execute(
+                'SELECT DISTINCT movie_id FROM ratings ORDER BY movie_id'):
+            yield movie
+
+    def __len__(self) -> int:
+        """Return the number of rated movies.
+        """
+        return self._ratings.connection.execute(
+            'SELECT COUNT(DISTINCT movie_id) FROM ratings').fetchone()[0]
+
+
+class SqliteNorms(Mapping):
+    """A read-only {user id: sum of squared ratings} view of a SqliteRatings.
+    """
+    _ratings: SqliteRatings
+
+    def __init__(self, ratings: SqliteRatings) -> None:
+        """Initialize a view of ratings.
+        """
+        self._ratings = ratings
+
+    def __getitem__(self, user: int) -> float:
+        """Return the sum of the squared ratings of user.
+        """
+        norm = self._ratings._buffered(
+            ('norm', user), 'SELECT norm FROM norms WHERE user_id = ?', user,
+            lambda rows: [norm for (norm,) in rows])
+        if len(norm) == 0:
+            raise KeyError(user)
+        return norm[0]
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the user ids in increasing order.
+        """
+        return iter(self._ratings)
+
+    def __len__(self) -> int:
+        """Return the number of users with ratings.
+        """
+        return len(self._ratings)
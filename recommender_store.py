@@ -0,0 +1,695 @@
+"""Compact array-backed storage for user movie ratings.
+
+A RatingStore keeps every rating in a few contiguous typed arrays instead of a
+dictionary of dictionaries:
+
+- the CSR (compressed sparse row) part holds, for every user, a run of
+  (movie id, rating) pairs sorted by movie id;
+- the CSC (compressed sparse column) part holds, for every movie, a run of the
+  user ids who rated it, sorted by user id. It stands in for movies_to_users.
+
+That is 4 + 4 bytes per rating for the rows and 4 bytes per rating for the
+columns, plus a small amount per user and per movie. Ratings are kept in
+single precision, which holds half-star ratings such as 3.5 exactly; a
+rating it would round, such as 3.3, is refused with a ValueError rather than
+stored changed.
+
+RatingStore is a read-only Mapping from user id to a Rating-like view, and
+RatingStore.movie_users is a read-only Mapping from movie id to user ids, so
+the functions in recommender_functions accept them in place of a
+UserRatingDict and a MovieUserDict.
+"""
+
+import itertools
+import operator
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+from recommender_constants import MovieDict, UserRatingDict
+
+ID_TYPE = 'i'
+RATING_TYPE = 'f'
+OFFSET_TYPE = 'q'
+NORM_TYPE = 'd'
+
+
+def append_rating(ratings: array, rate: float) -> None:
+    """Append rate to the RATING_TYPE array ratings.
+
+    Raise ValueError, leaving ratings unchanged, if rate cannot be stored
+    exactly in it.
+
+    >>> ratings = array(RATING_TYPE)
+    >>> append_rating(ratings, 3.5)
+    >>> append_rating(ratings, 3.3)
+    Traceback (most recent call last):
+    ...
+    ValueError: rating 3.3 cannot be stored exactly
+    >>> list(ratings)
+    [3.5]
+    """
+    ratings.append(rate)
+    if ratings[-1] != rate:
+        ratings.pop()
+        raise ValueError('rating {!r} cannot be stored exactly'.format(rate))
+
+
+def exact_ratings(ratings: Iterable[float]) -> array:
+    """Return a RATING_TYPE array of ratings.
+
+    Raise ValueError if a rating cannot be stored exactly in it.
+
+    >>> exact_ratings([0.5, 4.0])
+    array('f', [0.5, 4.0])
+    """
+    column = array(RATING_TYPE)
+    for rate in ratings:
+        append_rating(column, rate)
+    return column
+
+
+def is_dense(ids: Sequence[int]) -> bool:
+    """Return whether the sorted distinct ids are exactly 0, 1, ...,
+    len(ids) - 1, so that every id is its own index.
+
+    >>> is_dense([0, 1, 2])
+    True
+    >>> is_dense([0, 2, 3])
+    False
+    """
+    return len(ids) == 0 or (ids[0] == 0 and ids[-1] == len(ids) - 1)
+
+
+def find_id(ids: Sequence[int], key: object, dense: bool) -> int:
+    """Return the index of key in the sorted distinct ids, or -1 if it is not
+    there. If dense is True, ids must be 0, 1, ..., len(ids) - 1 and key is
+    its own index, with no search.
+
+    >>> find_id([3, 8, 20], 8, False)
+    1
+    >>> find_id([0, 1, 2], 2, True)
+    2
+    >>> find_id([0, 1, 2], 5, True)
+    -1
+    """
+    if dense:
+        if type(key) is int and 0 <= key < len(ids):
+            return key
+        return -1
+    i = bisect_left(ids, key)
+    if i < len(ids) and ids[i] == key:
+        return i
+    return -1
+
+
+class UserRatings(Mapping):
+    """A read-only view of one user's {movie id: rating} in a RatingStore.
+
+    === Private Attributes ===
+    _movie_ids: the movie id column of the store
+    _ratings: the rating column of the store
+    _start: index of this user's first rating
+    _end: index just past this user's last rating
+    """
+    _movie_ids: Sequence[int]
+    _ratings: Sequence[float]
+    _start: int
+    _end: int
+
+    def __init__(self, movie_ids: Sequence[int], ratings: Sequence[float],
+                 start: int, end: int) -> None:
+        """Initialize a view of movie_ids[start:end] and ratings[start:end].
+        """
+        self._movie_ids = movie_ids
+        self._ratings = ratings
+        self._start = start
+        self._end = end
+
+    def __getitem__(self, movie: int) -> float:
+        """Return this user's rating of movie.
+        """
+        i = bisect_left(self._movie_ids, movie, self._start, self._end)
+        if i < self._end and self._movie_ids[i] == movie:
+            return self._ratings[i]
+        raise KeyError(movie)
+
+    def __contains__(self, movie: object) -> bool:
+        """Return whether this user rated movie.
+        """
+        i = bisect_left(self._movie_ids, movie, self._start, self._end)
+        return i < self._end and self._movie_ids[i] == movie
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the rated movie ids in increasing order.
+        """
+        return iter(self._movie_ids[self._start:self._end])
+
+    def __len__(self) -> int:
+        """Return the number of movies this user rated.
+        """
+        return self._end - self._start
+
+    def __repr__(self) -> str:
+        """Return a dict-like representation of this view.
+        """
+        return repr(dict(self.items()))
+
+
+class MovieUsers(Mapping):
+    """A read-only {movie id: user ids} view of a RatingStore.
+
+    Each value is a sequence of user ids sorted in increasing order.
+
+    === Private Attributes ===
+    _movie_ids: the sorted distinct movie ids
+    _offsets: _offsets[i]:_offsets[i + 1] is the run of movie i in _user_ids
+    _user_ids: the users who rated each movie, grouped by movie
+    """
+    _movie_ids: Sequence[int]
+    _offsets: Sequence[int]
+    _user_ids: Sequence[int]
+    _dense: bool
+
+    def __init__(self, movie_ids: Sequence[int], offsets: Sequence[int],
+                 user_ids: Sequence[int]) -> None:
+        """Initialize a view over the column arrays of a RatingStore.
+        """
+        self._movie_ids = movie_ids
+        self._offsets = offsets
+        self._user_ids = user_ids
+        self._dense = is_dense(movie_ids)
+
+    def _find(self, movie: object) -> int:
+        """Return the column index of movie, or -1 if nobody rated it.
+        """
+        return find_id(self._movie_ids, movie, self._dense)
+
+    def __getitem__(self, movie: int) -> Sequence[int]:
+        """Return the ids of the users who rated movie.
+        """
+        i = self._find(movie)
+        if i < 0:
+            raise KeyError(movie)
+        return self._user_ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def __contains__(self, movie: object) -> bool:
+        """Return whether anybody rated movie.
+        """
+        return self._find(movie) >= 0
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the rated movie ids in increasing order.
+        """
+        return iter(self._movie_ids)
+
+    def __len__(self) -> int:
+        """Return the number of distinct rated movies.
+        """
+        return len(self._movie_ids)
+
+
+class UserNorms(Mapping):
+    """A read-only {user id: sum of squared ratings} view of a RatingStore.
+
+    === Private Attributes ===
+    _user_ids: the sorted distinct user ids
+    _norms: the sum of squared ratings of each user in _user_ids
+    """
+    _user_ids: Sequence[int]
+    _norms: Sequence[float]
+    _dense: bool
+
+    def __init__(self, user_ids: Sequence[int],
+                 norms: Sequence[float], dense: bool) -> None:
+        """Initialize a view over the user and norm arrays of a RatingStore.
+        dense tells whether user_ids is 0, 1, ..., len(user_ids) - 1.
+        """
+        self._user_ids = user_ids
+        self._norms = norms
+        self._dense = dense
+
+    def __getitem__(self, user: int) -> float:
+        """Return the sum of the squared ratings of user.
+        """
+        i = find_id(self._user_ids, user, self._dense)
+        if i < 0:
+            raise KeyError(user)
+        return self._norms[i]
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the user ids in increasing order.
+        """
+        return iter(self._user_ids)
+
+    def __len__(self) -> int:
+        """Return the number of users.
+        """
+        return len(self._user_ids)
+
+
+class RatingStore(Mapping):
+    """A read-only {user id: {movie id: rating}} mapping in CSR/CSC layout.
+
+    === Public Attributes ===
+    user_ids: the sorted distinct user ids
+    user_offsets: user_offsets[i]:user_offsets[i + 1] is the run of ratings
+        of user_ids[i] in movie_ids and ratings
+    movie_ids: the rated movie ids, grouped by user, sorted within a user
+    ratings: the ratings matching movie_ids
+    col_movie_ids: the sorted distinct rated movie ids
+    col_offsets: col_offsets[i]:col_offsets[i + 1] is the run of users of
+        col_movie_ids[i] in col_user_ids
+    col_user_ids: the users who rated each movie, grouped by movie, sorted
+        within a movie
+    norms: the sum of the squared ratings of each user in user_ids
+
+    === Representation Invariants ===
+    - len(user_offsets) == len(user_ids) + 1
+    - len(col_offsets) == len(col_movie_ids) + 1
+    - len(movie_ids) == len(ratings) == len(col_user_ids)
+    - len(norms) == len(user_ids)
+    - no user has two ratings for the same movie
+
+    >>> store = RatingStore.from_dict({2: {10: 4.0, 17: 5.0}, 1: {3671: 3.0}})
+    >>> len(store)
+    2
+    >>> store[2] == {10: 4.0, 17: 5.0}
+    True
+    >>> list(store.movie_users[10])
+    [2]
+    """
+    user_ids: Sequence[int]
+    user_offsets: Sequence[int]
+    movie_ids: Sequence[int]
+    ratings: Sequence[float]
+    col_movie_ids: Sequence[int]
+    col_offsets: Sequence[int]
+    col_user_ids: Sequence[int]
+    norms: Sequence[float]
+    _dense: bool
+
+    # The names of the array attributes, in the order __init__ takes them.
+    COLUMNS = ('user_ids', 'user_offsets', 'movie_ids', 'ratings',
+               'col_movie_ids', 'col_offsets', 'col_user_ids', 'norms')
+
+    def __init__(self, user_ids: Sequence[int], user_offsets: Sequence[int],
+                 movie_ids: Sequence[int], ratings: Sequence[float],
+                 col_movie_ids: Sequence[int], col_offsets: Sequence[int],
+                 col_user_ids: Sequence[int],
+                 norms: Sequence[float]) -> None:
+        """Initialize a store over already-built CSR and CSC arrays.
+
+        Use from_columns or from_dict to build the arrays from raw ratings.
+        """
+        self.user_ids = user_ids
+        self.user_offsets = user_offsets
+        self.movie_ids = movie_ids
+        self.ratings = ratings
+        self.col_movie_ids = col_movie_ids
+        self.col_offsets = col_offsets
+        self.col_user_ids = col_user_ids
+        self.norms = norms
+        self._dense = is_dense(user_ids)
+
+    @classmethod
+    def from_columns(cls, users: Sequence[int], movies: Sequence[int],
+                     ratings: Sequence[float]) -> 'RatingStore':
+        """Return a store of the ratings (users[i], movies[i], ratings[i]).
+
+        If a (user, movie) pair appears more than once, the last one wins, the
+        same as assigning into a UserRatingDict in order. Raise ValueError if
+        a rating cannot be stored exactly; see exact_ratings.
+
+        The ratings are grouped by user with a counting sort into arrays of
+        their final size, and each user's run is then sorted by movie on its
+        own, so nothing is kept per rating beyond the arrays themselves.
+
+        >>> store = RatingStore.from_columns([5, 1, 5], [7, 7, 7],
+        ...                                  [1.0, 2.0, 4.5])
+        >>> store[5][7]
+        4.5
+        >>> list(store.movie_users[7])
+        [1, 5]
+        """
+        n = len(users)
+        if not isinstance(ratings, array) or ratings.typecode != RATING_TYPE:
+            ratings = exact_ratings(ratings)
+        counts = {}
+        for user in users:
+            counts[user] = counts.get(user, 0) + 1
+        user_ids = array(ID_TYPE, sorted(counts))
+        ends = array(OFFSET_TYPE)
+        fill = {}
+        offset = 0
+        for user in user_ids:
+            fill[user] = offset
+            offset += counts[user]
+            ends.append(offset)
+        del counts
+
+        # Group the ratings by user, in their original order within a user.
+        if all(map(operator.le, users, itertools.islice(users, 1, None))):
+            movie_ids = array(ID_TYPE, movies)
+            row_ratings = array(RATING_TYPE, ratings)
+        else:
+            movie_ids = array(ID_TYPE, [0]) * n
+            row_ratings = array(RATING_TYPE, [0.0]) * n
+            for user, movie, rate in zip(users, movies, ratings):
+                p = fill[user]
+                movie_ids[p] = movie
+                row_ratings[p] = rate
+                fill[user] = p + 1
+        del fill
+
+        # Sort each user's run by movie, stably so that the last of several
+        # ratings of a movie wins, drop the others and close up the gaps.
+        user_offsets = array(OFFSET_TYPE, [0])
+        start = 0
+        size = 0
+        for end in ends:
+            run = movie_ids[start:end]
+            rates = row_ratings[start:end]
+            if all(map(operator.lt, run, itertools.islice(run, 1, None))):
+                movie_ids[size:size + len(run)] = run
+                row_ratings[size:size + len(run)] = rates
+                size += len(run)
+            else:
+                first = size
+                for i in sorted(range(len(run)), key=run.__getitem__):
+                    if size > first and movie_ids[size - 1] == run[i]:
+                        row_ratings[size - 1] = rates[i]
+                    else:
+                        movie_ids[size] = run[i]
+                        row_ratings[size] = rates[i]
+                        size += 1
+            user_offsets.append(size)
+            start = end
+        del movie_ids[size:]
+        del row_ratings[size:]
+        return cls._with_columns(user_ids, user_offsets, movie_ids,
+                                 row_ratings)
+
+    @classmethod
+    def from_dict(cls, user_ratings: UserRatingDict) -> 'RatingStore':
+        """Return a store holding the same ratings as user_ratings.
+
+        Users with no ratings are left out. Raise ValueError if a rating
+        cannot be stored exactly; see exact_ratings.
+        """
+        user_ids = array(ID_TYPE)
+        user_offsets = array(OFFSET_TYPE, [0])
+        movie_ids = array(ID_TYPE)
+        row_ratings = array(RATING_TYPE)
+        for user in sorted(user_ratings):
+            rating = user_ratings[user]
+            if len(rating) == 0:
+                continue
+            user_ids.append(user)
+            for movie in sorted(rating):
+                movie_ids.append(movie)
+                append_rating(row_ratings, rating[movie])
+            user_offsets.append(len(movie_ids))
+        return cls._with_columns(user_ids, user_offsets, movie_ids,
+                                 row_ratings)
+
+    @classmethod
+    def _with_columns(cls, user_ids: array, user_offsets: array,
+                      movie_ids: array, row_ratings: array) -> 'RatingStore':
+        """Return a store over the given CSR arrays, building the CSC arrays
+        and the per-user norms.
+        """
+        counts = {}
+        for movie in movie_ids:
+            counts[movie] = counts.get(movie, 0) + 1
+        col_movie_ids = array(ID_TYPE, sorted(counts))
+        col_offsets = array(OFFSET_TYPE, [0])
+        col_index = {}
+        for i in range(len(col_movie_ids)):
+            movie = col_movie_ids[i]
+            col_index[movie] = i
+            col_offsets.append(col_offsets[-1] + counts[movie])
+
+        col_user_ids = array(ID_TYPE, bytes(len(movie_ids) * 4))
+        fill = array(OFFSET_TYPE, col_offsets[:-1])
+        for row in range(len(user_ids)):
+            user = user_ids[row]
+            for p in range(user_offsets[row], user_offsets[row + 1]):
+                col = col_index[movie_ids[p]]
+                col_user_ids[fill[col]] = user
+                fill[col] += 1
+
+        norms = array(NORM_TYPE)
+        for row in range(len(user_ids)):
+            norm = 0.0
+            for p in range(user_offsets[row], user_offsets[row + 1]):
+                norm = norm + row_ratings[p] ** 2
+            norms.append(norm)
+        return cls(user_ids, user_offsets, movie_ids, row_ratings,
+                   col_movie_ids, col_offsets, col_user_ids, norms)
+
+    @property
+    def movie_users(self) -> MovieUsers:
+        """Return a {movie id: user ids} view of this store.
+        """
+        return MovieUsers(self.col_movie_ids, self.col_offsets,
+                          self.col_user_ids)
+
+    @property
+    def user_norms(self) -> UserNorms:
+        """Return a {user id: sum of squared ratings} view of this store.
+
+        >>> store = RatingStore.from_dict({1: {10: 3.0, 11: 4.0}})
+        >>> store.user_norms[1]
+        25.0
+        """
+        return UserNorms(self.user_ids, self.norms, self._dense)
+
+    def _row(self, user: object) -> int:
+        """Return the row index of user, or -1 if user has no ratings.
+        """
+        return find_id(self.user_ids, user, self._dense)
+
+    def __getitem__(self, user: int) -> UserRatings:
+        """Return a view of user's {movie id: rating}.
+        """
+        row = self._row(user)
+        if row < 0:
+            raise KeyError(user)
+        return UserRatings(self.movie_ids, self.ratings,
+                           self.user_offsets[row], self.user_offsets[row + 1])
+
+    def __contains__(self, user: object) -> bool:
+        """Return whether user has any ratings in this store.
+        """
+        return self._row(user) >= 0
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the user ids in increasing order.
+        """
+        return iter(self.user_ids)
+
+    def __len__(self) -> int:
+        """Return the number of users in this store.
+        """
+        return len(self.user_ids)
+
+    def num_ratings(self) -> int:
+        """Return the total number of ratings in this store.
+        """
+        return len(self.movie_ids)
+
+    def nbytes(self) -> int:
+        """Return the number of bytes used by the arrays of this store.
+        """
+        total = 0
+        for column in self._columns():
+            total += len(column) * column.itemsize
+        return total
+
+    def _columns(self) -> Iterable:
+        """Return every array of this store.
+        """
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    def filter_movies(self, movies: MovieDict) -> 'RatingStore':
+        """Return a store with only the ratings of movies in movies. Users
+        left with no ratings are removed.
+
+        This is the RatingStore counterpart of remove_unknown_movies.
+
+        >>> store = RatingStore.from_dict({1: {10: 4.0, 11: 3.0}, 2: {11: 5.0}})
+        >>> small = store.filter_movies({10: ('Ten', [])})
+        >>> list(small)
+        [1]
+        >>> small[1] == {10: 4.0}
+        True
+        """
+        user_ids = array(ID_TYPE)
+        user_offsets = array(OFFSET_TYPE, [0])
+        movie_ids = array(ID_TYPE)
+        row_ratings = array(RATING_TYPE)
+        for row in range(len(self.user_ids)):
+            start = len(movie_ids)
+            for p in range(self.user_offsets[row], self.user_offsets[row + 1]):
+                if self.movie_ids[p] in movies:
+                    movie_ids.append(self.movie_ids[p])
+                    row_ratings.append(self.ratings[p])
+            if len(movie_ids) > start:
+                user_ids.append(self.user_ids[row])
+                user_offsets.append(len(movie_ids))
+        return self._with_columns(user_ids, user_offsets, movie_ids,
+                                  row_ratings)
+
+
+def store_to_dict(store: RatingStore) -> Dict[int, Dict[int, float]]:
+    """Return store as a plain UserRatingDict.
+
+    >>> store_to_dict(RatingStore.from_dict({1: {10: 4.0}}))
+    {1: {10: 4.0}}
+    """
+    result = {}
+    for user in store:
+        result[user] = dict(store[user].items())
+    return result
+
+
+class IdMap:
+    """A mapping of sparse external ids to dense indices 0 to N - 1.
+
+    Indices follow the order of the external ids, so sorting by index sorts
+    by id, and ties broken by smaller id are broken the same way by smaller
+    index.
+
+    === Public Attributes ===
+    ids: the sorted distinct external ids; ids[index] is the external id of
+        index
+
+    === Private Attributes ===
+    _index: the index of each external id
+
+    >>> movie_map = IdMap([302156, 68735, 293660])
+    >>> movie_map.encode(293660)
+    1
+    >>> movie_map.decode(2)
+    302156
+    """
+    ids: array
+    _index: Dict[int, int]
+
+    def __init__(self, ids: Iterable[int]) -> None:
+        """Initialize a map of the distinct ids in ids.
+        """
+        self.ids = array(ID_TYPE, sorted(set(ids)))
+        self._index = {}
+        for i in range(len(self.ids)):
+            self._index[self.ids[i]] = i
+
+    def encode(self, external: int) -> int:
+        """Return the index of the external id.
+        """
+        return self._index[external]
+
+    def decode(self, index: int) -> int:
+        """Return the external id of index.
+        """
+        return self.ids[index]
+
+    def __contains__(self, external: object) -> bool:
+        """Return whether external is in this map.
+        """
+        return external in self._index
+
+    def __len__(self) -> int:
+        """Return the number of ids in this map.
+        """
+        return len(self.ids)
+
+
+class EncodedRatings:
+    """Ratings whose user and movie ids are dense indices.
+
+    The store's rows and columns are then indexed directly by user and movie
+    index instead of being searched for.
+
+    === Public Attributes ===
+    user_map: the index of each external user id
+    movie_map: the index of each external movie id
+    store: the ratings, by user index and movie index
+
+    >>> encoded = EncodedRatings.from_dict({1001: {302156: 4.0, 68735: 3.5}})
+    >>> list(encoded.store[0].items())
+    [(0, 3.5), (1, 4.0)]
+    >>> encoded.encode_rating({302156: 5.0, 99: 1.0})
+    {1: 5.0, 2: 1.0}
+    """
+    user_map: IdMap
+    movie_map: IdMap
+    store: RatingStore
+
+    def __init__(self, user_map: IdMap, movie_map: IdMap,
+                 store: RatingStore) -> None:
+        """Initialize over already-encoded ratings.
+        """
+        self.user_map = user_map
+        self.movie_map = movie_map
+        self.store = store
+
+    @classmethod
+    def from_dict(cls, user_ratings: UserRatingDict) -> 'EncodedRatings':
+        """Return the encoding of user_ratings, which may also be a
+        RatingStore.
+
+        A RatingStore's rows are remapped in place of being rebuilt: indices
+        follow id order, so each row stays sorted by movie.
+        """
+        if isinstance(user_ratings, RatingStore):
+            user_map = IdMap(user_ratings.user_ids)
+            movie_map = IdMap(user_ratings.col_movie_ids)
+            user_offsets = array(OFFSET_TYPE, user_ratings.user_offsets)
+            movie_ids = array(ID_TYPE, map(movie_map.encode,
+                                           user_ratings.movie_ids))
+            row_ratings = array(RATING_TYPE, user_ratings.ratings)
+        else:
+            user_map = IdMap(user for user in user_ratings
+                             if len(user_ratings[user]) > 0)
+            movies = set()
+            for user in user_map.ids:
+                movies.update(user_ratings[user])
+            movie_map = IdMap(movies)
+            user_offsets = array(OFFSET_TYPE, [0])
+            movie_ids = array(ID_TYPE)
+            row_ratings = array(RATING_TYPE)
+            for user in user_map.ids:
+                rating = user_ratings[user]
+                for movie in sorted(rating):
+                    movie_ids.append(movie_map.encode(movie))
+                    append_rating(row_ratings, rating[movie])
+                user_offsets.append(len(movie_ids))
+        user_ids = array(ID_TYPE, range(len(user_map)))
+        return cls(user_map, movie_map,
+                   RatingStore._with_columns(user_ids, user_offsets,
+                                             movie_ids, row_ratings))
+
+    def encode_rating(self, target_rating: Dict[int, float]) -> Dict[int,
+                                                                     float]:
+        """Return target_rating keyed by movie index, in the same order.
+
+        Movies nobody rated get new indices past the end of movie_map, so
+        they still count towards the target's norm but match no user.
+        """
+        dense = {}
+        unknown = len(self.movie_map)
+        for movie in target_rating:
+            if movie in self.movie_map:
+                dense[self.movie_map.encode(movie)] = target_rating[movie]
+            else:
+                dense[unknown] = target_rating[movie]
+                unknown += 1
+        return dense
+
+    def decode_movies(self, movies: Iterable[int]) -> List[int]:
+        """Return the external ids of the movie indices in movies.
+        """
+        return [self.movie_map.decode(movie) for movie in movies]
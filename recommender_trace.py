@@ -0,0 +1,116 @@
+"""Per-stage timing records for recommend_movies.
+
+Install a StageTrace with recommender_functions.set_tracer to have every
+recommend_movies call record how long each stage took and how much work it
+did:
+
+    fan_out       get_shared_scores: reading the posting lists of the target's
+                  movies and the dot products with every co-rating user
+    similarity    turning the dot products into similarity scores
+    candidates    get_can: candidate movie generation
+    scoring       accumulating the candidate scores
+    top_k         get_top_movies: picking the final num_movies
+
+along with the number of similar users, candidates and scored (user, movie)
+pairs. With no tracer installed, recommend_movies only pays for one check.
+"""
+
+import json
+from collections import deque
+from typing import Dict, List, TextIO
+
+STAGES = ('fan_out', 'similarity', 'candidates', 'scoring', 'top_k')
+
+
+class StageTrace:
+    """The most recent per-stage records of recommend_movies calls.
+
+    === Public Attributes ===
+    records: one {'seconds': {stage: seconds}, 'counts': {name: count}}
+        dictionary per call, oldest first, at most max_records of them
+
+    >>> trace = StageTrace()
+    >>> trace.record({'fan_out': 0.002, 'top_k': 0.001}, {'candidates': 7})
+    >>> trace.summary()['fan_out']['p50']
+    0.002
+    >>> trace.summary()['counts']['candidates']['max']
+    7
+    """
+    records: deque
+
+    def __init__(self, max_records: int = 100000) -> None:
+        """Initialize an empty trace that keeps the last max_records calls.
+        """
+        self.records = deque(maxlen=max_records)
+
+    def record(self, seconds: Dict[str, float],
+               counts: Dict[str, int]) -> None:
+        """Add the stage times and counts of one call.
+        """
+        self.records.append({'seconds': seconds, 'counts': counts})
+
+    def clear(self) -> None:
+        """Remove every record.
+        """
+        self.records.clear()
+
+    def write_json_lines(self, output: TextIO) -> None:
+        """Write each record to output as one line of JSON.
+        """
+        for record in self.records:
+            output.write(json.dumps(record) + '\n')
+
+    def summary(self) -> Dict[str, Dict[str, object]]:
+        """Return, for each stage, the number of calls, total seconds and the
+        p50, p90, p99 and max seconds, and a histogram of the times. Under
+        'counts', return the mean and max of each count.
+
+        The histogram maps the upper bound of each bucket, in microseconds and
+        a power of 2, to the number of calls that fell in it.
+        """
+        result = {}
+        for stage in STAGES:
+            times = sorted(record['seconds'][stage]
+                           for record in self.records
+                           if stage in record['seconds'])
+            if times:
+                result[stage] = {'calls': len(times), 'total': sum(times),
+                                 'p50': _nearest_rank(times, 0.5),
+                                 'p90': _nearest_rank(times, 0.9),
+                                 'p99': _nearest_rank(times, 0.99),
+                                 'max': times[-1],
+                                 'histogram': histogram(times)}
+        counts = {}
+        for record in self.records:
+            for name in record['counts']:
+                counts.setdefault(name, []).append(record['counts'][name])
+        result['counts'] = {name: {'mean': sum(values) / len(values),
+                                   'max': max(values)}
+                            for name, values in counts.items()}
+        return result
+
+
+def _nearest_rank(ordered: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile fraction of the sorted ordered.
+
+    >>> _nearest_rank([1.0, 2.0, 3.0, 4.0], 0.5)
+    2.0
+    """
+    rank = max(1, -(-len(ordered) * fraction // 1))
+    return ordered[int(rank) - 1]
+
+
+def histogram(seconds: List[float]) -> Dict[int, int]:
+    """Return a {bucket upper bound in microseconds: count} of seconds, with
+    power of 2 buckets.
+
+    >>> histogram([0.000001, 0.000003, 0.000004, 0.0001])
+    {1: 1, 4: 2, 128: 1}
+    """
+    buckets = {}
+    for value in seconds:
+        bound = 1
+        while bound < value * 1e6:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return dict(sorted(buckets.items()))
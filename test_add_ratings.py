@@ -0,0 +1,126 @@
+"""Unit test for recommender_functions.add_ratings and remove_ratings"""
+import unittest
+
+from recommender_functions import (add_ratings, remove_ratings,
+                                   remove_unknown_movies, movies_to_users,
+                                   get_user_norms, get_similar_users,
+                                   get_users_who_watched)
+
+
+class TestAddRemoveRatings(unittest.TestCase):
+
+    def setUp(self):
+        self.user_ratings = {1: {10: 3.0, 11: 4.0}, 3: {10: 5.0}}
+        self.movie_users = movies_to_users(self.user_ratings)
+        self.user_norms = get_user_norms(self.user_ratings)
+
+    def assert_consistent(self):
+        """
+        the indexes match a rebuild from user_ratings
+        """
+        self.assertEqual(self.movie_users,
+                         movies_to_users(self.user_ratings))
+        self.assertEqual(self.user_norms, get_user_norms(self.user_ratings))
+
+    def test_add_new_user(self):
+        """
+        a new user is inserted in order in the movie's user list
+        """
+        add_ratings({2: {10: 1.0}}, self.user_ratings, self.movie_users,
+                    self.user_norms)
+        self.assertEqual(self.movie_users[10], [1, 2, 3])
+        self.assertEqual(self.user_norms[2], 1.0)
+
+    def test_add_no_ratings(self):
+        """
+        a user with no new ratings is not added
+        """
+        add_ratings({2: {}, 1: {}}, self.user_ratings, self.movie_users,
+                    self.user_norms)
+        self.assertEqual(self.user_ratings, {1: {10: 3.0, 11: 4.0},
+                                             3: {10: 5.0}})
+        self.assert_consistent()
+
+    def test_add_replaces_rating(self):
+        """
+        rating an already rated movie replaces the rating
+        """
+        add_ratings({1: {10: 1.0, 12: 2.0}}, self.user_ratings,
+                    self.movie_users, self.user_norms)
+        self.assertEqual(self.user_ratings[1], {10: 1.0, 11: 4.0, 12: 2.0})
+        self.assert_consistent()
+
+    def test_remove_rating(self):
+        """
+        removing a rating updates the user's norm
+        """
+        remove_ratings({1: [11]}, self.user_ratings, self.movie_users,
+                       self.user_norms)
+        self.assertEqual(self.user_ratings[1], {10: 3.0})
+        self.assert_consistent()
+
+    def test_remove_last_rating(self):
+        """
+        users and movies with nothing left are removed
+        """
+        remove_ratings({3: [10], 1: [11]}, self.user_ratings,
+                       self.movie_users, self.user_norms)
+        self.assertNotIn(3, self.user_ratings)
+        self.assertNotIn(11, self.movie_users)
+        self.assert_consistent()
+
+    def test_remove_missing(self):
+        """
+        removing a rating that does not exist does nothing
+        """
+        remove_ratings({1: [99], 7: [10]}, self.user_ratings,
+                       self.movie_users, self.user_norms)
+        self.assertEqual(self.user_ratings, {1: {10: 3.0, 11: 4.0},
+                                             3: {10: 5.0}})
+        self.assert_consistent()
+
+
+    def test_unsorted_movie_users(self):
+        """
+        users who watched are right for user lists not built in order, also
+        after adding to them
+        """
+        movie_users = {10: [3, 1], 11: [1]}
+        add_ratings({2: {10: 4.0, 11: 4.0}}, self.user_ratings, movie_users)
+        self.assertEqual(get_users_who_watched([10, 11], movie_users),
+                         [1, 2, 3])
+
+
+class TestUserNorms(unittest.TestCase):
+
+    def setUp(self):
+        self.user_ratings = {1: {10: 3.0}, 2: {10: 5.0, 12: 1.0}}
+        self.movie_users = movies_to_users(self.user_ratings)
+
+    def test_edit_in_place(self):
+        """
+        ratings changed in place are scored with their new norms
+        """
+        self.user_ratings[1][11] = 5.0
+        self.user_ratings[3] = {10: 2.0}
+        self.movie_users = movies_to_users(self.user_ratings)
+        actual = get_similar_users({10: 4.0}, self.user_ratings,
+                                   self.movie_users)
+        self.assertEqual(actual, {1: 9.0 / 34.0, 2: 25.0 / 26.0, 3: 1.0})
+
+    def test_user_missing_from_norms(self):
+        """
+        a user missing from the given norms has their norm computed
+        """
+        user_norms = get_user_norms(self.user_ratings)
+        add_ratings({3: {10: 2.0}}, self.user_ratings, self.movie_users)
+        actual = get_similar_users({10: 4.0}, self.user_ratings,
+                                   self.movie_users, user_norms)
+        self.assertEqual(actual, get_similar_users({10: 4.0},
+                                                   self.user_ratings,
+                                                   self.movie_users))
+
+
+if __name__ == '__main__':
+
+    unittest.main(exit=False)
@@ -0,0 +1,100 @@
+"""Unit test for recommender_parallel.read_rating_store_parallel"""
+import os
+import random
+import tempfile
+import unittest
+
+from recommender_functions import read_ratings, read_rating_store
+from recommender_parallel import byte_ranges, read_rating_store_parallel
+from recommender_store import RatingStore, store_to_dict
+
+HEADER = 'userId,movieId,rating\n'
+
+
+def write_file(text):
+    """
+    return the path of a new temporary file holding text
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'ratings.csv')
+    with open(path, 'w') as rating_file:
+        rating_file.write(text)
+    return path
+
+
+class TestReadRatingStoreParallel(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(148)
+        lines = []
+        for user in range(1, 60):
+            for movie in rand.sample(range(1, 300), rand.randint(1, 25)):
+                lines.append('{},{},{}\n'.format(
+                    user, movie * 7, rand.choice([0.5, 3.0, 4.5])))
+        # Rate some movies again, so the later rating in the file must win.
+        lines.extend(rand.sample(lines, 40))
+        lines = [line.replace(',3.0', ',1.0') for line in lines[:40]] + \
+            lines[40:]
+        rand.shuffle(lines)
+        self.text = HEADER + ''.join(lines)
+        self.path = write_file(self.text)
+        with open(self.path) as rating_file:
+            self.expected = read_ratings(rating_file)
+        with open(self.path) as rating_file:
+            self.store = read_rating_store(rating_file)
+
+    def assert_same_store(self, store):
+        """
+        store holds the same ratings and arrays as read_rating_store
+        """
+        self.assertEqual(store_to_dict(store), self.expected)
+        for name in RatingStore.COLUMNS:
+            self.assertEqual(list(getattr(store, name)),
+                             list(getattr(self.store, name)), name)
+
+    def test_shuffled_duplicates(self):
+        """
+        a shuffled file with repeated ratings gives the same store for 1 to
+        64 ranges
+        """
+        for parts in [1, 2, 3, 7, 16, 64]:
+            store = read_rating_store_parallel(self.path, 2, parts)
+            self.assert_same_store(store)
+
+    def test_no_trailing_newline(self):
+        """
+        the last line is read even without a newline
+        """
+        path = write_file(self.text.rstrip('\n'))
+        for parts in [1, 5]:
+            ranges = byte_ranges(path, parts)
+            self.assertEqual(ranges[-1][1], os.path.getsize(path))
+            self.assert_same_store(read_rating_store_parallel(path, 2,
+                                                              parts))
+
+    def test_header_only(self):
+        """
+        a file with only a header has no ranges and gives an empty store
+        """
+        for text in [HEADER, HEADER.rstrip('\n')]:
+            path = write_file(text)
+            self.assertEqual(byte_ranges(path, 4), [])
+            store = read_rating_store_parallel(path, 2)
+            self.assertEqual(len(store), 0)
+            self.assertEqual(list(store.movie_users), [])
+
+    def test_ranges_cover_lines(self):
+        """
+        the ranges start right after the header and end at line ends
+        """
+        ranges = byte_ranges(self.path, 9)
+        self.assertEqual(ranges[0][0], len(HEADER))
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, 'rb') as rating_file:
+            data = rating_file.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b'\n')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,108 @@
+"""Unit test for recommender_store.RatingStore"""
+import random
+import unittest
+
+from recommender_store import RatingStore, EncodedRatings, store_to_dict
+from recommender_functions import movies_to_users, recommend_movies
+
+
+class TestRatingStore(unittest.TestCase):
+
+    def test_from_dict(self):
+        """
+        same ratings as the dictionary
+        """
+        user_ratings = {2: {10: 4.0, 17: 5.0}, 1: {3671: 3.0, 2968: 1.0}}
+        actual = store_to_dict(RatingStore.from_dict(user_ratings))
+        self.assertEqual(actual, user_ratings)
+
+    def test_from_columns_last_wins(self):
+        """
+        duplicate user movie pair keeps the last rating
+        """
+        store = RatingStore.from_columns([1, 1, 1], [10, 11, 10],
+                                         [2.0, 3.0, 4.5])
+        self.assertEqual(store_to_dict(store), {1: {10: 4.5, 11: 3.0}})
+
+    def test_from_columns_shuffled(self):
+        """
+        ratings in any order give the same store as the dictionary built
+        from them in order
+        """
+        rand = random.Random(148)
+        rows = [(rand.randrange(30), rand.randrange(40),
+                 rand.randrange(1, 11) / 2) for _ in range(500)]
+        user_ratings = {}
+        for user, movie, rate in rows:
+            user_ratings.setdefault(user, {})[movie] = rate
+        users, movies, ratings = zip(*rows)
+        store = RatingStore.from_columns(users, movies, ratings)
+        expected = RatingStore.from_dict(user_ratings)
+        for name in RatingStore.COLUMNS:
+            self.assertEqual(list(getattr(store, name)),
+                             list(getattr(expected, name)), name)
+
+    def test_inexact_rating(self):
+        """
+        a rating that single precision would round is refused
+        """
+        self.assertRaises(ValueError, RatingStore.from_dict, {1: {10: 3.3}})
+        self.assertRaises(ValueError, RatingStore.from_columns, [1], [10],
+                          [3.3])
+
+    def test_movie_users(self):
+        """
+        movie_users view matches movies_to_users
+        """
+        user_ratings = {1: {10: 3.0, 9: 2.0}, 2: {10: 3.5}}
+        store = RatingStore.from_dict(user_ratings)
+        actual = {movie: list(store.movie_users[movie])
+                  for movie in store.movie_users}
+        self.assertEqual(actual, movies_to_users(user_ratings))
+
+    def test_missing_user(self):
+        """
+        missing user and movie raise KeyError
+        """
+        store = RatingStore.from_dict({1: {10: 3.0}})
+        self.assertNotIn(2, store)
+        self.assertNotIn(11, store[1])
+        self.assertRaises(KeyError, store.__getitem__, 2)
+        self.assertRaises(KeyError, store.movie_users.__getitem__, 11)
+
+    def test_recommend_movies(self):
+        """
+        recommend_movies gives the same answer on a store
+        """
+        user_ratings = {1: {10: 3.0, 11: 4.0, 12: 5.0},
+                        2: {10: 4.5, 13: 4.0},
+                        3: {11: 1.0, 12: 3.5, 14: 4.0}}
+        store = RatingStore.from_dict(user_ratings)
+        target = {10: 4.0, 11: 2.0}
+        expected = recommend_movies(target, {}, user_ratings,
+                                    movies_to_users(user_ratings), 3)
+        actual = recommend_movies(target, {}, store, store.movie_users, 3)
+        self.assertEqual(actual, expected)
+
+    def test_encoded_from_store(self):
+        """
+        encoding a store gives the same indices and arrays as encoding the
+        dictionary
+        """
+        user_ratings = {7: {302156: 4.0, 68735: 3.5}, 3: {293660: 1.0},
+                        5: {}, 4: {68735: 2.0, 293660: 5.0}}
+        expected = EncodedRatings.from_dict(user_ratings)
+        actual = EncodedRatings.from_dict(RatingStore.from_dict(user_ratings))
+        self.assertEqual(list(actual.user_map.ids), [3, 4, 7])
+        self.assertEqual(list(actual.movie_map.ids), [68735, 293660, 302156])
+        self.assertEqual(store_to_dict(actual.store),
+                         {0: {1: 1.0}, 1: {0: 2.0, 1: 5.0},
+                          2: {0: 3.5, 2: 4.0}})
+        for name in RatingStore.COLUMNS:
+            self.assertEqual(list(getattr(actual.store, name)),
+                             list(getattr(expected.store, name)), name)
+
+
+if __name__ == '__main__':
+
+    unittest.main(exit=False)
@@ -0,0 +1,116 @@
+"""Unit test for recommender_server.MicroBatcher and serve"""
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from recommender_functions import recommend_movies
+from recommender_server import MicroBatcher, serve, handle_client, \
+    request_recommendations
+
+# User 3 rated everything zero, so any target that shares a movie with them
+# fails with a division by zero when it is scored.
+USER_RATINGS = {1: {68735: 3.5, 302156: 4.0}, 2: {68735: 1.0, 293660: 4.5},
+                3: {302156: 0.0}}
+MOVIE_USERS = {68735: [1, 2], 293660: [2], 302156: [1, 3]}
+GOOD = {293660: 4.5}
+BAD = {302156: 4.5}
+
+
+class TestRecommenderServer(unittest.TestCase):
+
+    def setUp(self):
+        self.expected = recommend_movies(GOOD, {}, USER_RATINGS, MOVIE_USERS,
+                                         2)
+
+    def test_failure_stays_in_its_request(self):
+        """
+        a request that fails to score does not fail the rest of its batch
+        """
+        async def run():
+            batcher = MicroBatcher({}, USER_RATINGS, MOVIE_USERS,
+                                   max_batch=2, max_delay=60.0)
+            runner = asyncio.ensure_future(batcher.run())
+            results = await asyncio.gather(batcher.recommend(BAD, 2),
+                                           batcher.recommend(GOOD, 2),
+                                           return_exceptions=True)
+            runner.cancel()
+            return results, batcher.batches
+
+        (bad, good), batches = asyncio.run(run())
+        self.assertIsInstance(bad, ZeroDivisionError)
+        self.assertEqual(good, self.expected)
+        self.assertEqual(batches, 1)
+
+    def test_pruning(self):
+        """
+        the batcher prunes similar users as recommend_movies does
+        """
+        target = {68735: 4.5}
+
+        async def run():
+            batcher = MicroBatcher({}, USER_RATINGS, MOVIE_USERS,
+                                   max_batch=1, max_neighbours=1)
+            runner = asyncio.ensure_future(batcher.run())
+            result = await batcher.recommend(target, 2)
+            runner.cancel()
+            return result
+
+        self.assertEqual(asyncio.run(run()),
+                         recommend_movies(target, {}, USER_RATINGS,
+                                          MOVIE_USERS, 2, None, 1))
+
+    def test_serve_bad_and_good_requests(self):
+        """
+        one connection gets an error for each bad request and the right
+        answer for the good one, all scored in one batch
+        """
+        socket_path = os.path.join(tempfile.mkdtemp(), 'recommender.sock')
+
+        async def run():
+            batcher = MicroBatcher({}, USER_RATINGS, MOVIE_USERS,
+                                   max_batch=2, max_delay=60.0)
+            server = asyncio.ensure_future(serve(batcher, socket_path))
+            while not os.path.exists(socket_path):
+                await asyncio.sleep(0.01)
+            answers = await request_recommendations(
+                [(BAD, 2), ({68735: 0.0}, 2), (GOOD, 2)], socket_path)
+            server.cancel()
+            return answers, batcher.batches
+
+        answers, batches = asyncio.run(run())
+        self.assertIn('error', answers[0])
+        self.assertIn('error', answers[1])
+        self.assertEqual(answers[2], self.expected)
+        self.assertEqual(batches, 1)
+
+    def test_client_goes_away(self):
+        """
+        a client that pipelines more than max_pending lines and leaves does
+        not leave its handler waiting forever
+        """
+        async def run():
+            batcher = MicroBatcher({}, USER_RATINGS, MOVIE_USERS)
+            runner = asyncio.ensure_future(batcher.run())
+            server_socket, client_socket = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server_socket)
+            handler = asyncio.ensure_future(
+                handle_client(batcher, reader, writer, max_pending=4))
+            _, client = await asyncio.open_connection(sock=client_socket)
+            line = json.dumps({'rating': GOOD, 'num_movies': 2})
+            client.write((line + '\n').encode('utf-8') * 2000)
+            await client.drain()
+            client.transport.abort()
+            try:
+                await asyncio.wait_for(handler, 5)
+            finally:
+                runner.cancel()
+            return handler.done()
+
+        self.assertTrue(asyncio.run(run()))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
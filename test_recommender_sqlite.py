@@ -0,0 +1,54 @@
+"""Unit test for recommender_sqlite.build_database"""
+import os
+import tempfile
+import unittest
+from io import StringIO
+
+from recommender_functions import read_movies
+from recommender_sqlite import build_database, SqliteRatings
+
+MOVIES = ('movieId,title,date,vote,genres\n'
+          '10,Ten,,,Drama,War\n'
+          '11,Eleven,,,\n'
+          '12,Twelve,,\n')
+RATINGS = 'userId,movieId,rating\n1,10,4.0\n2,11,3.5\n'
+
+
+class TestBuildDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'ratings.db')
+        build_database(self.path, StringIO(MOVIES), StringIO(RATINGS))
+
+    def test_rebuild(self):
+        """
+        building again over an existing database replaces it
+        """
+        build_database(self.path, StringIO(MOVIES),
+                       StringIO('userId,movieId,rating\n3,12,2.0\n'))
+        ratings = SqliteRatings.open(self.path)
+        self.assertEqual(list(ratings), [3])
+        ratings.close()
+
+    def test_failed_build(self):
+        """
+        a build that fails leaves the old database and no partial file
+        """
+        self.assertRaises(ValueError, build_database, self.path,
+                          StringIO(MOVIES), StringIO(RATINGS + 'x,y,z\n'))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        ratings = SqliteRatings.open(self.path)
+        self.assertEqual(list(ratings), [1, 2])
+        ratings.close()
+
+    def test_movies(self):
+        """
+        movies read back the same as read_movies, empty genres included
+        """
+        ratings = SqliteRatings.open(self.path)
+        self.assertEqual(ratings.movies(), read_movies(StringIO(MOVIES)))
+        ratings.close()
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
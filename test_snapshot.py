@@ -0,0 +1,144 @@
+"""Unit test for recommender_snapshot.load_snapshot and load_or_build"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from recommender_snapshot import load_snapshot, save_snapshot, \
+    load_or_build, MAGIC, FORMAT_VERSION
+from recommender_store import RatingStore, store_to_dict
+
+USER_RATINGS = {1: {10: 4.0, 17: 5.0}, 2: {10: 3.5}, 3: {17: 1.0}}
+MOVIES = {10: ('Toy Story (1995)', ['Adventure', 'Animation']),
+          17: ('Sense and Sensibility (1995)', ['Drama', 'Romance'])}
+
+
+class TestLoadSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+        save_snapshot(self.path, RatingStore.from_dict(USER_RATINGS), MOVIES,
+                      [])
+        with open(self.path, 'rb') as snapshot:
+            self.data = snapshot.read()
+
+    def write(self, data):
+        """
+        replace the snapshot with data
+        """
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write(data)
+
+    def test_round_trip(self):
+        """
+        a whole snapshot loads the same store and movies in both modes
+        """
+        for use_mmap in [False, True]:
+            store, movies = load_snapshot(self.path, None, use_mmap)
+            self.assertEqual(store_to_dict(store), USER_RATINGS)
+            self.assertEqual(movies, MOVIES)
+
+    def test_truncated(self):
+        """
+        a snapshot missing its last bytes is refused in both modes
+        """
+        for cut in [40, len(self.data) // 2, len(self.data) - 10]:
+            self.write(self.data[:-cut])
+            for use_mmap in [False, True]:
+                self.assertIsNone(load_snapshot(self.path, None, use_mmap))
+
+    def test_empty(self):
+        """
+        an empty file is refused in both modes
+        """
+        self.write(b'')
+        for use_mmap in [False, True]:
+            self.assertIsNone(load_snapshot(self.path, None, use_mmap))
+
+    def test_header_missing_entries(self):
+        """
+        a header without its sections or sources is refused
+        """
+        sections = {'version': FORMAT_VERSION, 'byteorder': sys.byteorder,
+                    'sources': []}
+        sources = dict(sections, sections=[])
+        del sources['sources']
+        for header, checked in [(sections, None), (sources, [self.path]),
+                                (dict(sections, sections=[{}]), None),
+                                ([], None)]:
+            text = json.dumps(header).encode('utf-8')
+            self.write(MAGIC + len(text).to_bytes(8, 'little') + text)
+            self.assertIsNone(load_snapshot(self.path, checked))
+
+
+class TestLoadOrBuild(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self.movie_path = os.path.join(directory, 'movies.csv')
+        self.rating_path = os.path.join(directory, 'ratings.csv')
+        with open(self.movie_path, 'w') as movie_file:
+            movie_file.write('movieId,title,date,vote,genres\n'
+                             '10,Ten,,,Drama\n17,Seventeen,,,\n')
+        self.write_ratings('1,10,4.0\n2,17,3.5\n')
+
+    def write_ratings(self, lines):
+        """
+        replace the ratings file with the header and lines
+        """
+        with open(self.rating_path, 'w') as rating_file:
+            rating_file.write('userId,movieId,rating\n' + lines)
+
+    def load(self, use_hash=False):
+        """
+        return the ratings load_or_build gives as a dictionary
+        """
+        store, _ = load_or_build(self.snapshot_path, self.movie_path,
+                                 self.rating_path, use_hash)
+        return store_to_dict(store)
+
+    def test_reuses_current_snapshot(self):
+        """
+        a snapshot whose sources have not changed is loaded, not rebuilt
+        """
+        self.load()
+        before = os.stat(self.snapshot_path).st_mtime_ns
+        self.assertEqual(self.load(), {1: {10: 4.0}, 2: {17: 3.5}})
+        self.assertEqual(os.stat(self.snapshot_path).st_mtime_ns, before)
+
+    def test_size_changed(self):
+        """
+        a source that grew is parsed again
+        """
+        self.load()
+        self.write_ratings('1,10,4.0\n2,17,3.5\n3,10,1.0\n')
+        self.assertEqual(self.load(), {1: {10: 4.0}, 2: {17: 3.5},
+                                       3: {10: 1.0}})
+
+    def test_mtime_changed(self):
+        """
+        a source rewritten with the same size is parsed again
+        """
+        self.load()
+        info = os.stat(self.rating_path)
+        self.write_ratings('1,10,5.0\n2,17,3.5\n')
+        os.utime(self.rating_path, ns=(info.st_atime_ns,
+                                       info.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.load(), {1: {10: 5.0}, 2: {17: 3.5}})
+
+    def test_hash_changed(self):
+        """
+        with use_hash, a source changed without its size or modification
+        time changing is parsed again
+        """
+        self.load(True)
+        info = os.stat(self.rating_path)
+        self.write_ratings('1,10,5.0\n2,17,3.5\n')
+        os.utime(self.rating_path, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertEqual(self.load(True), {1: {10: 5.0}, 2: {17: 3.5}})
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)